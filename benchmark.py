@@ -0,0 +1,447 @@
+"""Офлайн-бенчмарк обработчиков бота без Telegram, удаленного сервера и PostgreSQL.
+
+Обработчики из bot.py вызываются с настоящими объектами Update. Команды SSH
+выполняет SSH-сервер paramiko внутри процесса, который отдает записанный
+вывод, а вместо asyncpg используется пул в памяти с имитацией задержки сети
+(или настоящая БД, если указан --dsn).
+
+Запуск: python benchmark.py --requests 200 --concurrency 1 10 50 [--scenario get_ss ...]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shlex
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+import paramiko
+from telegram import Bot, Update
+
+import bot
+
+# --- SSH ---------------------------------------------------------------------
+
+DPKG_STAMP = "1715670000 1048576"
+
+
+def _recorded_outputs():
+    rng = random.Random(1)
+    ss = "".join(
+        f"tcp ESTAB 0 0 10.0.0.{i % 250}:{40000 + i} 10.0.1.{i % 250}:5432\n" for i in range(200)
+    ) + "".join(f"udp UNCONN 0 0 0.0.0.0:{5000 + i} 0.0.0.0:*\n" for i in range(20))
+    services = json.dumps([
+        {"unit": f"service-{i}.service", "load": "loaded", "active": "active", "sub": "running",
+         "description": f"Benchmark service {i}"}
+        for i in range(60)
+    ])
+    ps = "".join(
+        f"{1000 + i} user{i % 5} {rng.uniform(0, 50):.1f} {rng.uniform(0, 5):.1f} proc-{i}\n" for i in range(10)
+    )
+    last = "".join(
+        f"user{i} pts/{i} 10.0.0.{i} 2024-05-14T09:{i:02d}:00+03:00 - 2024-05-14T10:{i:02d}:00+03:00 (01:00)\n"
+        for i in range(10)
+    ) + "\nwtmp begins 2024-05-01T00:00:00+03:00\n"
+    journal = "".join(
+        json.dumps({"__REALTIME_TIMESTAMP": str(1715670000000000 + i), "SYSLOG_IDENTIFIER": "kernel",
+                    "MESSAGE": f"critical event {i}"}) + "\n"
+        for i in range(5)
+    )
+    packages = "".join(f"libbench{i}:amd64\t1.{i}.0-1\n" for i in range(3000))
+
+    def dpkg(command):
+        if f"= '{DPKG_STAMP}'" in command:
+            return DPKG_STAMP + "\n"
+        return DPKG_STAMP + "\n" + packages
+
+    return {
+        "ss": ss,
+        "systemctl": services,
+        # services_command выбирает формат по версии systemd внутри if.
+        "if": services,
+        "ps": ps,
+        "last": last,
+        "journalctl": journal,
+        "df": "Filesystem Size Used Avail Use% Mounted on\n/dev/sda1 50G 20G 30G 40% /\n",
+        "free": "total used free\nMem: 16Gi 4Gi 12Gi\n",
+        "uptime": " 10:00:00 up 10 days,  1 user,  load average: 0.10, 0.20, 0.30\n",
+        "cat": 'PRETTY_NAME="Debian GNU/Linux 12 (bookworm)"\nID=debian\n',
+        "uname": "Linux bench 6.1.0-21-amd64 #1 SMP Debian x86_64 GNU/Linux\n",
+        "s=$(stat": dpkg,
+    }
+
+
+class RecordedSSHServer(paramiko.ServerInterface):
+    """Принимает любой пароль и отвечает на exec записанным выводом по первому слову команды."""
+
+    def __init__(self, outputs, delay):
+        self.outputs = outputs
+        self.delay = delay
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode()
+        prefix = ""
+        if command.startswith("setsid "):
+            # Команды фоновых задач обернуты в setsid: отвечаем на вложенную команду.
+            command = shlex.split(command)[-1]
+            prefix = "@@pid 1\n"
+        output = self.outputs.get(command.split()[0], "")
+        if callable(output):
+            output = output(command)
+
+        def reply():
+            if self.delay:
+                time.sleep(self.delay)
+            channel.sendall((prefix + output).encode())
+            channel.send_exit_status(0)
+            # Закрывает канал клиент: серверное закрытие могло бы опередить ответ на exec.
+            channel.shutdown_write()
+
+        threading.Thread(target=reply, daemon=True).start()
+        return True
+
+
+def start_ssh_server(delay=0.0):
+    """Запускает SSH-сервер на свободном порту 127.0.0.1 и возвращает порт."""
+    host_key = paramiko.RSAKey.generate(2048)
+    outputs = _recorded_outputs()
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+
+    def accept():
+        while True:
+            client, _ = listener.accept()
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.start_server(server=RecordedSSHServer(outputs, delay))
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+# --- PostgreSQL --------------------------------------------------------------
+
+class FakeRecord(tuple):
+    """Запись с доступом по индексу и по имени столбца, как asyncpg.Record."""
+
+    def __new__(cls, columns, values):
+        record = super().__new__(cls, values)
+        record._columns = columns
+        return record
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._columns.index(key)
+        return super().__getitem__(key)
+
+
+def _like(pattern):
+    """Переводит шаблон LIKE (с экранированием обратной косой чертой) в регулярное выражение."""
+    regex = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            regex.append(re.escape(char))
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "%":
+            regex.append(".*")
+        elif char == "_":
+            regex.append(".")
+        else:
+            regex.append(re.escape(char))
+    return re.compile("".join(regex) + "$")
+
+
+class FakeDatabase:
+    """Таблицы phone_numbers и email_addresses в памяти и разбор запросов, которые шлет bot.py.
+
+    Неизвестный запрос вызывает NotImplementedError, чтобы подмена не расходилась с ботом молча.
+    """
+
+    ANY = re.compile(r"SELECT (\w+) FROM (\w+) WHERE \1 = ANY\(\$1::text\[\]\)")
+    INSERT = re.compile(r"INSERT INTO (\w+) \((\w+)\) SELECT v FROM unnest")
+    PAGE = re.compile(r"SELECT id, (\w+) FROM (\w+) WHERE id ([<>]) \$1 AND .* ORDER BY id( DESC)? LIMIT \$3")
+    SCAN = re.compile(r"SELECT id, (\w+) FROM (\w+) WHERE id > \$1 ORDER BY id$")
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.tables = {"phone_numbers": {}, "email_addresses": {}}
+        self.round_trips = 0
+
+    def seed(self, table, values):
+        rows = self.tables[table]
+        for value in values:
+            rows.setdefault(value, len(rows) + 1)
+
+    def run(self, query, args):
+        query = " ".join(query.split())
+        if query.startswith("CREATE UNIQUE INDEX"):
+            return []
+        if match := self.ANY.match(query):
+            column, table = match.groups()
+            rows = self.tables[table]
+            return [FakeRecord((column,), (value,)) for value in args[0] if value in rows]
+        if match := self.INSERT.match(query):
+            table, column = match.groups()
+            rows = self.tables[table]
+            inserted = [value for value in dict.fromkeys(args[0]) if value not in rows]
+            self.seed(table, inserted)
+            return [FakeRecord((column,), (value,)) for value in inserted]
+        if match := self.PAGE.match(query):
+            column, table, op, desc = match.groups()
+            cursor, pattern, limit = args
+            regex = _like(pattern) if pattern else None
+            # Как CONTACT_FILTER_EXPR: номер сравнивается по цифрам без кода страны.
+            key = (lambda value: re.sub(r"\D", "", value)[1:]) if table == "phone_numbers" else str.lower
+            ordered = sorted(((row_id, value) for value, row_id in self.tables[table].items()), reverse=bool(desc))
+            result = []
+            for row_id, value in ordered:
+                if (row_id > cursor if op == ">" else row_id < cursor) and (not regex or regex.match(key(value))):
+                    result.append(FakeRecord(("id", column), (row_id, value)))
+                    if len(result) == limit:
+                        break
+            return result
+        if match := self.SCAN.match(query):
+            column, table = match.groups()
+            return [FakeRecord(("id", column), (row_id, value))
+                    for value, row_id in sorted(self.tables[table].items(), key=lambda item: item[1])
+                    if row_id > args[0]]
+        raise NotImplementedError(query)
+
+
+class FakeTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+
+    async def _round_trip(self, query, args):
+        self.database.round_trips += 1
+        await asyncio.sleep(self.database.latency)
+        return self.database.run(query, args)
+
+    async def fetch(self, query, *args):
+        return await self._round_trip(query, args)
+
+    async def execute(self, query, *args):
+        await self._round_trip(query, args)
+        return "OK"
+
+    def transaction(self):
+        return FakeTransaction()
+
+    async def cursor(self, query, *args, prefetch=50):
+        for record in await self._round_trip(query, args):
+            yield record
+
+
+class FakePool:
+    """Пул с ограничением числа соединений, как у asyncpg.Pool."""
+
+    def __init__(self, database, size=10):
+        self.database = database
+        self.size = size
+        self._free = asyncio.Semaphore(size)
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                await pool._free.acquire()
+                return FakeConnection(pool.database)
+
+            async def __aexit__(self, *exc):
+                pool._free.release()
+                return False
+
+        return Acquire()
+
+    def get_size(self):
+        return self.size
+
+    def get_idle_size(self):
+        return self._free._value
+
+    async def close(self):
+        pass
+
+
+# --- Telegram ----------------------------------------------------------------
+
+class BenchBot(Bot):
+    """Бот, который считает исходящие вызовы API вместо отправки их в Telegram."""
+
+    def __init__(self):
+        super().__init__(token="0:bench")
+        # Атрибуты Bot заморожены после инициализации, поэтому счетчик — изменяемый объект.
+        with self._unfrozen():
+            self.counters = {"calls": 0}
+
+    async def _record(self, **kwargs):
+        self.counters["calls"] += 1
+
+    async def send_message(self, *args, **kwargs):
+        await self._record()
+        return SimpleNamespace(message_id=self.counters["calls"])
+
+    async def send_document(self, *args, **kwargs):
+        await self._record()
+
+    async def edit_message_text(self, *args, **kwargs):
+        await self._record()
+
+    async def answer_callback_query(self, *args, **kwargs):
+        await self._record()
+
+
+def make_update(bench_bot, update_id, chat_id, text):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": text,
+        },
+    }, bench_bot)
+
+
+def _contacts_text(rng, count):
+    phones = [f"+7 (9{rng.randint(10, 99)}) {rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(10, 99)}"
+              for _ in range(count)]
+    emails = [f"user{rng.randint(0, 10 ** 6)}@example.com" for _ in range(count)]
+    return "Контакты: " + ", ".join(phones + emails)
+
+
+def awaiting_jobs(handler):
+    """Дожидается фоновых задач, поставленных обработчиком, чтобы замер включал их выполнение."""
+    async def run(update, context):
+        jobs = bot.get_job_manager().jobs
+        before = set(jobs)
+        await handler(update, context)
+        await asyncio.gather(*(job.task for job_id, job in list(jobs.items())
+                               if job_id not in before and job.chat_id == update.effective_chat.id))
+    return run
+
+
+def scenarios():
+    rng = random.Random(2)
+    text = _contacts_text(rng, 25)
+    return {
+        "find_phone_number": (bot.find_phone_number, text, []),
+        "find_email": (bot.find_email, text, []),
+        "get_ss": (bot.get_ss, "/get_ss", []),
+        "get_ss_listen": (bot.get_ss, "/get_ss tcp listen", ["tcp", "listen"]),
+        "get_services": (bot.get_services, "/get_services", []),
+        "get_ps": (bot.get_ps, "/get_ps", []),
+        "get_auths": (bot.get_auths, "/get_auths", []),
+        "get_critical": (awaiting_jobs(bot.get_critical), "/get_critical", []),
+        "get_df": (bot.get_df, "/get_df", []),
+        "get_uptime": (bot.get_uptime, "/get_uptime", []),
+        "get_apt_list": (bot.get_apt_list, "lib", []),
+        "get_emails": (bot.get_emails, "/get_emails", []),
+        "get_phone_numbers": (bot.get_phone_numbers, "/get_phone_numbers", []),
+    }
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_scenario(bench_bot, handler, text, args, requests, concurrency):
+    """Выполняет requests вызовов обработчика не более чем по concurrency одновременно."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            update = make_update(bench_bot, i + 1, 100_000 + i, text)
+            context = SimpleNamespace(bot=bench_bot, args=list(args), user_data={})
+            started = time.perf_counter()
+            await handler(update, context)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    await bot.send_scheduler.close(timeout=60)
+    return requests / elapsed, sorted(latencies)
+
+
+async def main(options):
+    os.environ.update(RM_HOST="127.0.0.1", RM_PORT=str(start_ssh_server(options.ssh_delay)),
+                      RM_USER="bench", RM_PASSWORD="bench")
+    bot.inventory = None
+    bot.ssh_pools.clear()
+    bot.send_scheduler = bot.SendScheduler(global_rate=1e9, chat_interval=0)
+    if options.dsn:
+        import asyncpg
+        bot.db_pool = await asyncpg.create_pool(dsn=options.dsn)
+        database = None
+    else:
+        database = FakeDatabase(options.db_latency)
+        rng = random.Random(3)
+        database.seed("email_addresses", (f"user{rng.randint(0, 10 ** 6)}@example.com" for _ in range(5000)))
+        database.seed("phone_numbers", (f"+7 (9{i % 90 + 10}) {i % 900 + 100}-{i % 90 + 10}-{i % 80 + 10}"
+                                        for i in range(5000)))
+        bot.db_pool = FakePool(database, size=int(os.getenv("DB_POOL_MAX", "10")))
+    await bot.refresh_contact_indexes(full=True)
+
+    bench_bot = BenchBot()
+    selected = scenarios()
+    if options.scenario:
+        selected = {name: selected[name] for name in options.scenario}
+
+    print(f"{'сценарий':<20}{'параллельно':>12}{'запр/с':>10}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}")
+    for name, (handler, text, args) in selected.items():
+        for concurrency in options.concurrency:
+            rate, latencies = await run_scenario(bench_bot, handler, text, args, options.requests, concurrency)
+            print(f"{name:<20}{concurrency:>12}{rate:>10.1f}"
+                  f"{percentile(latencies, 0.5) * 1000:>9.1f}{percentile(latencies, 0.95) * 1000:>9.1f}"
+                  f"{percentile(latencies, 0.99) * 1000:>9.1f}")
+
+    if database is not None:
+        print(f"\nОбращений к БД: {database.round_trips}, вызовов Telegram API: {bench_bot.counters['calls']}")
+    if options.verbose:
+        print("\n" + bot.metrics.summary())
+    for pool in bot.ssh_pools.values():
+        pool.close()
+    await bot.db_pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--scenario", nargs="+", choices=sorted(scenarios()))
+    parser.add_argument("--ssh-delay", type=float, default=0.0, help="задержка ответа SSH-сервера, с")
+    parser.add_argument("--db-latency", type=float, default=0.0005, help="задержка одного запроса к БД, с")
+    parser.add_argument("--dsn", help="строка подключения к настоящей PostgreSQL вместо подмены")
+    parser.add_argument("--verbose", action="store_true", help="вывести метрики бота по SSH, БД и отправкам")
+    asyncio.run(main(parser.parse_args()))
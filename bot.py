@@ -1,46 +1,572 @@
+import io
+import json
 import re
 import logging
+import logging.handlers
+import queue
+import shlex
+import socket
 import os
+import asyncio
+import bisect
+import functools
+import itertools
+import threading
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import paramiko
 import asyncpg
 from dotenv import load_dotenv
 from pathlib import Path
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes, ConversationHandler, CallbackQueryHandler, CallbackContext
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes, ConversationHandler, CallbackQueryHandler, CallbackContext, BaseUpdateProcessor
+from extractor import extract_contacts, extract_from_file, format_phone_number
+import collectors
+from metrics import Metrics, serve_prometheus
+from persistence import PostgresPersistence
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging():
+    """Настраивает журналирование через очередь: запись в файл идет в отдельном потоке.
+
+    Переменные окружения: LOG_FILE, LOG_LEVEL, LOG_LEVELS ("httpx=WARNING,telegram=INFO"),
+    LOG_ROTATE (size или time), LOG_MAX_BYTES, LOG_WHEN, LOG_BACKUP_COUNT, LOG_JSON.
+    Возвращает запущенный QueueListener, который нужно остановить при выходе.
+    """
+    filename = os.getenv("LOG_FILE", "logfile.txt")
+    backup_count = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+    if os.getenv("LOG_ROTATE", "size") == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when=os.getenv("LOG_WHEN", "midnight"), backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+            backupCount=backup_count, encoding="utf-8")
+    json_output = os.getenv("LOG_JSON", "").lower() in ("1", "true", "yes")
+    file_handler.setFormatter(JsonFormatter() if json_output else logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    for item in os.getenv("LOG_LEVELS", "httpx=WARNING").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+metrics = Metrics()
+
 
-logging.basicConfig(filename='logfile.txt',format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',level=logging.DEBUG,
-    encoding="utf-8")
-logging.debug('Отладочная информация.')
-logging.info('модуль logging')
-logging.warning('Предупреждение')
-logging.error('Произошла шибка')
-logging.critical('Критическая ошибка')
+class TimedRequest(HTTPXRequest):
+    """HTTP-клиент бота, замеряющий каждый вызов Telegram API по имени метода.
+
+    Так в метрики попадают все исходящие вызовы: отправки из очереди, правки
+    сообщений, ответы на нажатия кнопок. getUpdates идет через отдельный
+    клиент и не замеряется.
+    """
+
+    async def post(self, url, *args, **kwargs):
+        with metrics.timer("send", url.rsplit("/", 1)[-1]):
+            return await super().post(url, *args, **kwargs)
 
 ASK_PACKAGE = 0
 MAX_TELEGRAM_MESSAGE_LENGTH = 4096
 
 
+STREAM_DOCUMENT_THRESHOLD = int(os.getenv("STREAM_DOCUMENT_THRESHOLD", str(2 * MAX_TELEGRAM_MESSAGE_LENGTH)))
+
+
 def split_message(text: str, limit: int = MAX_TELEGRAM_MESSAGE_LENGTH) -> list[str]:
-    """Разделяет сообщение на части, чтобы оно не превышало максимальную длину."""
-    return [text[i:i + limit] for i in range(0, len(text), limit)]
+    """Разделяет сообщение на части по границам строк, чтобы оно не превышало максимальную длину."""
+    parts = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        # Строку длиннее лимита приходится резать принудительно.
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ""
+        current += line
+    if current:
+        parts.append(current)
+    return [part for part in parts if part.strip()]
+
+
+class OutgoingMessage(NamedTuple):
+    text: str = None
+    reply_markup: object = None
+    document: object = None
+    filename: str = None
+
+
+class SendScheduler:
+    """Очередь исходящих сообщений с учетом лимитов Telegram.
+
+    Сообщения одного чата отправляются по порядку отдельной задачей; соседние
+    короткие тексты склеиваются до максимальной длины (сообщения с клавиатурой
+    не склеиваются). Между отправками в чат
+    выдерживается интервал, общий поток ограничен глобальным лимитом, а ответы
+    429 и сетевые ошибки повторяются с задержкой.
+    """
+
+    def __init__(self, global_rate=25.0, chat_interval=1.0, max_retries=5):
+        self.global_interval = 1.0 / global_rate
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._queues = {}
+        self._workers = {}
+        self._global_lock = asyncio.Lock()
+        self._next_global = 0.0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            global_rate=float(os.getenv("SEND_GLOBAL_RATE", "25")),
+            chat_interval=float(os.getenv("SEND_CHAT_INTERVAL", "1.0")),
+            max_retries=int(os.getenv("SEND_MAX_RETRIES", "5")),
+        )
+
+    def enqueue(self, bot, chat_id, text=None, reply_markup=None, document=None, filename=None) -> None:
+        """Ставит сообщение в очередь чата; длинный текст делится по строкам.
+
+        Переданный document закрывается после отправки.
+        """
+        queue = self._queues.setdefault(chat_id, deque())
+        if document is not None:
+            queue.append(OutgoingMessage(text, reply_markup, document, filename))
+        else:
+            *head, last = split_message(text) or [""]
+            queue.extend(OutgoingMessage(part) for part in head)
+            if last.strip():
+                queue.append(OutgoingMessage(last, reply_markup))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(bot, chat_id))
+
+    def _next_batch(self, queue):
+        item = queue.popleft()
+        if item.document is not None or item.reply_markup is not None:
+            return item
+        text = item.text
+        while queue:
+            following = queue[0]
+            # Сообщение с клавиатурой уходит отдельно: по нажатию кнопки его текст
+            # заменяется целиком и не должен уносить с собой чужой вывод.
+            if (following.document is not None or following.reply_markup is not None
+                    or len(text) + 1 + len(following.text) > MAX_TELEGRAM_MESSAGE_LENGTH):
+                break
+            queue.popleft()
+            text = f"{text}\n{following.text}"
+        return OutgoingMessage(text)
+
+    async def _global_slot(self):
+        async with self._global_lock:
+            loop = asyncio.get_running_loop()
+            wait = self._next_global - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next_global = max(loop.time(), self._next_global) + self.global_interval
+
+    async def _send(self, bot, chat_id, item):
+        for attempt in range(self.max_retries + 1):
+            await self._global_slot()
+            try:
+                if item.document is not None:
+                    item.document.seek(0)
+                    return await bot.send_document(chat_id=chat_id, document=item.document,
+                                                   filename=item.filename, caption=item.text,
+                                                   reply_markup=item.reply_markup)
+                return await bot.send_message(chat_id=chat_id, text=item.text, reply_markup=item.reply_markup)
+            except RetryAfter as error:
+                await asyncio.sleep(error.retry_after)
+            except (BadRequest, Forbidden):
+                # BadRequest наследует NetworkError, но повтор не поможет: сообщение отбрасывается.
+                raise
+            except NetworkError:
+                await asyncio.sleep(min(2 ** attempt, 30))
+        logging.warning("Сообщение в чат %s не отправлено после %s попыток", chat_id, self.max_retries + 1)
+
+    async def _drain(self, bot, chat_id):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                item = self._next_batch(queue)
+                try:
+                    await self._send(bot, chat_id, item)
+                except Exception as error:
+                    # Сообщение отбрасывается, но обработчик очереди чата продолжает работу.
+                    logging.error("Ошибка отправки в чат %s: %s", chat_id, error)
+                finally:
+                    if item.document is not None:
+                        item.document.close()
+                if queue:
+                    await asyncio.sleep(self.chat_interval)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                self._queues.pop(chat_id, None)
+
+    async def close(self, timeout=5.0):
+        """Дает очередям время доотправить сообщения, затем прерывает их."""
+        workers = list(self._workers.values())
+        if workers:
+            _, pending = await asyncio.wait(workers, timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+
+send_scheduler = SendScheduler.from_env()
+
+
+def reply_later(update: Update, context: CallbackContext, text, reply_markup=None) -> None:
+    """Ставит ответ в очередь отправки, не дожидаясь самой отправки."""
+    send_scheduler.enqueue(context.bot, update.effective_chat.id, text, reply_markup)
+
+
+async def reply_lines(update: Update, context: CallbackContext, lines, filename="output.txt",
+                      empty_text="Информация не найдена.") -> None:
+    """Отправляет построчный вывод сообщениями, а при большом объеме — одним файлом."""
+    buffer = []
+    size = 0
+    document = None
+    async for line in lines:
+        if document is not None:
+            document.write(line.encode() + b"\n")
+            continue
+        buffer.append(line)
+        size += len(line) + 1
+        if size > STREAM_DOCUMENT_THRESHOLD:
+            document = io.BytesIO()
+            document.write("\n".join(buffer).encode() + b"\n")
+            buffer = []
+
+    if document is not None:
+        send_scheduler.enqueue(context.bot, update.effective_chat.id, document=document, filename=filename)
+        return
+
+    text = "\n".join(buffer)
+    reply_later(update, context, text if text.strip() else empty_text)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("Команда отменена.")
+    reply_later(update, context, "Команда отменена.")
     return ConversationHandler.END
 
-def ssh(command):
-    host = os.getenv("RM_HOST")
-    port = int(os.getenv("RM_PORT"))
-    username = os.getenv("RM_USER")
-    password = os.getenv("RM_PASSWORD")
+class SSHPool:
+    """Пул долгоживущих SSH-соединений.
+
+    Каждая команда выполняется в отдельном канале уже открытого транспорта,
+    поэтому параллельные команды стоят каналов, а не рукопожатий. Блокирующие
+    вызовы paramiko выполняются в ограниченном пуле потоков.
+    """
+
+    def __init__(self, host, port, username, password, size=2, max_workers=16, timeout=30.0, key_filename=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.key_filename = key_filename
+        self.timeout = timeout
+        self._clients = [None] * size
+        self._locks = [threading.Lock() for _ in range(size)]
+        self._slots = itertools.cycle(range(size))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ssh")
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            host=config.host,
+            port=config.port,
+            username=config.username,
+            password=config.password,
+            key_filename=config.key_filename,
+            size=int(os.getenv("SSH_POOL_SIZE", "2")),
+            max_workers=int(os.getenv("SSH_MAX_WORKERS", "16")),
+            timeout=float(os.getenv("SSH_COMMAND_TIMEOUT", "30")),
+        )
+
+    def _transport(self, slot):
+        """Возвращает живой транспорт слота, переподключаясь при необходимости."""
+        with self._locks[slot]:
+            client = self._clients[slot]
+            transport = client.get_transport() if client else None
+            if transport is None or not transport.is_active():
+                if client:
+                    client.close()
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                # Без TCP_NODELAY мелкие пакеты SSH ждут отложенного ACK (~40 мс на команду).
+                sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                client.connect(hostname=self.host, port=self.port, username=self.username,
+                               password=self.password, key_filename=self.key_filename,
+                               timeout=self.timeout, sock=sock)
+                client.get_transport().set_keepalive(30)
+                self._clients[slot] = client
+                transport = client.get_transport()
+            return transport
+
+    def _drop(self, slot):
+        with self._locks[slot]:
+            if self._clients[slot]:
+                self._clients[slot].close()
+            self._clients[slot] = None
+
+    def _open_channel(self, timeout):
+        slot = next(self._slots)
+        for attempt in range(2):
+            try:
+                channel = self._transport(slot).open_session(timeout=timeout)
+            except (paramiko.SSHException, EOFError, OSError):
+                # Транспорт мог быть разорван сервером: переподключаемся один раз.
+                self._drop(slot)
+                if attempt:
+                    raise
+                continue
+            channel.settimeout(timeout)
+            return channel
+
+    @staticmethod
+    def _read(channel, timeout, on_output, stopped=None):
+        """Читает вывод канала до завершения команды, но не дольше timeout секунд.
+
+        stdout порциями передается в on_output, stderr возвращается целиком.
+        Канал опрашивается короткими интервалами: так stderr вычитывается
+        вместе с stdout и не забивает окно канала, а срок действует на всю
+        команду, а не на паузу между порциями вывода.
+        """
+        deadline = time.monotonic() + timeout
+        errors = []
+        while not (stopped and stopped.is_set()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"команда не завершилась за {timeout:g} с")
+            while channel.recv_stderr_ready():
+                errors.append(channel.recv_stderr(32768))
+            channel.settimeout(min(remaining, 0.2))
+            try:
+                chunk = channel.recv(32768)
+            except socket.timeout:
+                continue
+            if not chunk:
+                break
+            on_output(chunk)
+        # После EOF буфер stderr закрыт, и чтение не блокируется.
+        while chunk := channel.recv_stderr(32768):
+            errors.append(chunk)
+        return b"".join(errors).decode(errors="replace")
+
+    def _exec(self, command, timeout, raw=False):
+        channel = self._open_channel(timeout)
+        try:
+            channel.exec_command(command)
+            output = []
+            error = self._read(channel, timeout, output.append)
+            output = b"".join(output)
+            return (output if raw else output.decode()), error
+        finally:
+            channel.close()
+
+    def _pump(self, command, timeout, put, stopped, opened):
+        """Читает stdout порциями и передает их в put; в конце передает stderr.
+
+        Открытый канал передается в opened, чтобы потребитель мог закрыть его
+        и прервать ожидание recv.
+        """
+        try:
+            channel = self._open_channel(timeout)
+        except Exception as e:
+            put(e)
+            return
+        opened(channel)
+        try:
+            channel.exec_command(command)
+            error = self._read(channel, timeout, put, stopped)
+            if not stopped.is_set():
+                put(error)
+        except Exception as e:
+            put(e)
+        finally:
+            channel.close()
+
+    async def run(self, command, timeout=None, raw=False):
+        """Выполняет команду и возвращает (stdout, stderr); с raw stdout возвращается байтами."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._exec, command, timeout or self.timeout, raw)
+
+    async def stream(self, command, timeout=None):
+        """Асинхронно отдает строки stdout по мере их поступления.
+
+        Ошибка команды или исключение возвращаются последней строкой в том же
+        виде, что и у ssh().
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=16)
+        stopped = threading.Event()
+        channels = []
+
+        def put(item):
+            if not stopped.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def opened(channel):
+            channels.append(channel)
+            if stopped.is_set():
+                channel.close()
+
+        pump = loop.run_in_executor(self._executor, self._pump, command, timeout or self.timeout,
+                                    put, stopped, opened)
+        tail = b""
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, bytes):
+                    *lines, tail = (tail + item).split(b"\n")
+                    for line in lines:
+                        yield line.decode(errors="replace")
+                    continue
+                if tail:
+                    yield tail.decode(errors="replace")
+                if isinstance(item, Exception):
+                    yield f"Произошло исключение: {str(item)}"
+                elif item:
+                    yield f"Ошибка: {item}"
+                break
+        finally:
+            # Потребитель мог остановиться раньше (в том числе по отмене): закрытый
+            # канал сразу прерывает recv, и поток чтения не ждет вывода команды.
+            stopped.set()
+            for channel in channels:
+                channel.close()
+            while not queue.empty():
+                queue.get_nowait()
+            await pump
+
+    def close(self):
+        for slot in range(len(self._clients)):
+            self._drop(slot)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class HostConfig(NamedTuple):
+    name: str
+    host: str
+    port: int
+    username: str
+    password: str = None
+    key_filename: str = None
+    groups: tuple = ()
+
+
+def load_inventory():
+    """Читает список хостов из JSON-файла HOSTS_FILE.
+
+    Формат: {"имя": {"host": ..., "port": 22, "user": ..., "password" или
+    "password_env" (имя переменной окружения), "key": путь к ключу, "groups": [...]}}.
+    Без файла используется один хост "default" из переменных RM_*.
+    """
+    path = os.getenv("HOSTS_FILE")
+    if not path:
+        return {"default": HostConfig("default", os.getenv("RM_HOST"), int(os.getenv("RM_PORT", "22")),
+                                      os.getenv("RM_USER"), os.getenv("RM_PASSWORD"), os.getenv("RM_KEY"))}
+    with open(path, encoding="utf-8") as file:
+        entries = json.load(file)
+    if not entries:
+        raise ValueError(f"В {path} нет ни одного хоста")
+    inventory = {}
+    for name, entry in entries.items():
+        password = entry.get("password")
+        if entry.get("password_env"):
+            password = os.getenv(entry["password_env"])
+        inventory[name] = HostConfig(name, entry["host"], int(entry.get("port", 22)), entry.get("user"),
+                                     password, entry.get("key"), tuple(entry.get("groups", ())))
+    return inventory
+
+
+inventory = None
+ssh_pools = {}
+
+
+def get_inventory():
+    global inventory
+    if inventory is None:
+        inventory = load_inventory()
+    return inventory
+
+
+def default_host():
+    return os.getenv("DEFAULT_HOST") or next(iter(get_inventory()))
+
+
+def resolve_targets(args):
+    """Отделяет от аргументов цели вида @хост, @группа или @all.
+
+    Возвращает (список хостов, остальные аргументы); без целей — хост по умолчанию.
+    """
+    hosts = get_inventory()
+    names = []
+    rest = []
+    for arg in args or []:
+        if not arg.startswith("@") or len(arg) == 1:
+            rest.append(arg)
+            continue
+        target = arg[1:]
+        if target == "all":
+            names.extend(hosts)
+        elif target in hosts:
+            names.append(target)
+        else:
+            members = [name for name, config in hosts.items() if target in config.groups]
+            if not members:
+                raise ValueError(f"Неизвестный хост или группа: {target}")
+            names.extend(members)
+    return list(dict.fromkeys(names)) or [default_host()], rest
+
+
+def get_ssh_pool(host=None):
+    host = host or default_host()
+    pool = ssh_pools.get(host)
+    if pool is None:
+        pool = ssh_pools[host] = SSHPool.from_config(get_inventory()[host])
+    return pool
+
 
+async def ssh(command, timeout=None, host=None, label=None):
+    """Выполняет команду; label — имя команды в метриках (по умолчанию первое слово)."""
+    started = time.perf_counter()
+    failed = True
     try:
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(hostname=host, port=port, username=username, password=password)
-        stdin, stdout, stderr = client.exec_command(command)
-        output = stdout.read().decode()
-        error = stderr.read().decode()
+        output, error = await get_ssh_pool(host).run(command, timeout)
+        failed = bool(error)
         if error:
             return f"Ошибка: {error}"
         else:
@@ -48,39 +574,531 @@ def ssh(command):
     except Exception as e:
         return f"Произошло исключение: {str(e)}"
     finally:
-        client.close()
+        metrics.observe("ssh", label or command.split()[0], time.perf_counter() - started, failed)
 
 
-async def db_query(query: str, args=None, fetch=True):
+async def ssh_stream(command, timeout=None, host=None, label=None):
+    """Построчно отдает вывод команды, не накапливая его целиком."""
+    started = time.perf_counter()
+    failed = False
     try:
-        conn = await asyncpg.connect(
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT"),
-            database=os.getenv("DB_DATABASE")
-        )
-        if fetch:
-            result = await conn.fetch(query, *args) if args else await conn.fetch(query)
+        async for line in get_ssh_pool(host).stream(command, timeout):
+            failed = is_ssh_error(line)
+            yield line
+    finally:
+        metrics.observe("ssh", label or command.split()[0], time.perf_counter() - started, failed)
+
+
+def is_ssh_error(result) -> bool:
+    return result.startswith(("Ошибка: ", "Произошло исключение: "))
+
+
+class TTLCache:
+    """LRU-кэш с временем жизни записей.
+
+    Одновременные запросы одного ключа объединяются: выполняется одна загрузка,
+    результат которой получают все ожидающие.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._inflight = {}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    async def _load(self, key, ttl, factory, cacheable):
+        try:
+            value = await factory()
+            if cacheable(value):
+                self.set(key, value, ttl)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    async def get_or_load(self, key, ttl, factory, refresh=False, cacheable=lambda value: True):
+        if not refresh:
+            value = self.get(key)
+            if value is not None:
+                return value
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, ttl, factory, cacheable))
+            self._inflight[key] = task
+        # shield: отмена одного ожидающего не должна прерывать загрузку для остальных.
+        return await asyncio.shield(task)
+
+
+SSH_CACHE_TTL = {
+    "cat /etc/os-release": 3600,
+    "uname -a": 3600,
+    "df -h": 5,
+    "free -h": 5,
+    collectors.services_command([])[0]: 10,
+}
+ssh_cache = TTLCache(maxsize=int(os.getenv("SSH_CACHE_SIZE", "128")))
+
+
+async def cached_ssh(command, refresh=False, host=None, label=None):
+    """Выполняет команду через кэш; ошибки не кэшируются."""
+    ttl = SSH_CACHE_TTL.get(command)
+    if ttl is None:
+        return await ssh(command, host=host, label=label)
+    return await ssh_cache.get_or_load((host or default_host(), command), ttl,
+                                       lambda: ssh(command, host=host, label=label),
+                                       refresh=refresh, cacheable=lambda result: not is_ssh_error(result))
+
+
+def wants_refresh(context) -> bool:
+    return any(arg.lower() == "refresh" for arg in context.args or [])
+
+
+FANOUT_LIMIT = int(os.getenv("FANOUT_LIMIT", "10"))
+FANOUT_TIMEOUT = float(os.getenv("FANOUT_TIMEOUT", "30"))
+
+
+def select_hosts(update: Update, context: CallbackContext):
+    """Возвращает (хосты, аргументы) команды; при неизвестной цели отвечает и возвращает None."""
+    try:
+        return resolve_targets(context.args)
+    except (OSError, ValueError) as error:
+        reply_later(update, context, str(error))
+        return None
+
+
+async def gather_hosts(hosts, produce, timeout=None) -> str:
+    """Выполняет produce(host) на всех хостах и объединяет результаты в один текст.
+
+    Одновременно опрашивается не больше FANOUT_LIMIT хостов, и каждый
+    ограничен timeout секундами (по умолчанию FANOUT_TIMEOUT), так что
+    недоступный хост не задерживает ответ остальных.
+    """
+    timeout = timeout or FANOUT_TIMEOUT
+    semaphore = asyncio.Semaphore(FANOUT_LIMIT)
+
+    async def run(host):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(produce(host), timeout)
+            except asyncio.TimeoutError:
+                return f"Ошибка: хост не ответил за {timeout:g} с"
+            except Exception as e:
+                return f"Произошло исключение: {str(e)}"
+
+    results = await asyncio.gather(*(run(host) for host in hosts))
+    if len(hosts) == 1:
+        return results[0]
+    return "\n\n".join(f"=== {host} ===\n{result}" for host, result in zip(hosts, results))
+
+
+async def fan_out(update: Update, context: CallbackContext, hosts, produce) -> None:
+    """Выполняет produce(host) на всех хостах и отправляет один общий ответ."""
+    reply_later(update, context, await gather_hosts(hosts, produce))
+
+
+async def run_command(update: Update, context: CallbackContext, command) -> None:
+    """Выполняет команду на выбранных хостах через кэш и отправляет вывод."""
+    selected = select_hosts(update, context)
+    if selected is None:
+        return
+    hosts, _ = selected
+    refresh = wants_refresh(context)
+    await fan_out(update, context, hosts, lambda host: cached_ssh(command, refresh=refresh, host=host))
+
+
+JOB_MAX_TOTAL = int(os.getenv("JOB_MAX_TOTAL", "4"))
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "2"))
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "600"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "900"))
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "5"))
+# Команда задачи запускается лидером новой группы процессов и первой строкой
+# сообщает ее номер, чтобы отмена могла завершить всю группу на хосте.
+JOB_WRAPPER = "setsid -w sh -c 'echo \"@@pid $$\"; exec sh -c \"$1\"' job {command}"
+JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED = (
+    "в очереди", "выполняется", "готово", "ошибка", "отменено")
+
+
+class Job:
+    def __init__(self, job_id, user_id, chat_id, title):
+        self.id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.title = title
+        self.status = JOB_QUEUED
+        self.created = time.monotonic()
+        self.finished = None
+        self.lines = 0
+        self.result = None
+        self.message_id = None
+        self.remote = {}
+        self.task = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in (JOB_QUEUED, JOB_RUNNING)
+
+    def describe(self) -> str:
+        elapsed = (self.finished or time.monotonic()) - self.created
+        return f"Задача #{self.id} ({self.title}): {self.status}, {elapsed:.0f} с, строк: {self.lines}"
+
+
+class JobManager:
+    """Фоновые задачи с долгими удаленными командами.
+
+    Одновременно выполняется не больше max_total задач и не больше
+    max_per_user задач одного пользователя. Ход задачи отражается в
+    обновляемом сообщении, а результат хранится retention секунд.
+    """
+
+    def __init__(self, max_total, max_per_user, retention):
+        self.max_per_user = max_per_user
+        self.retention = retention
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._semaphore = asyncio.Semaphore(max_total)
+
+    def _prune(self):
+        now = time.monotonic()
+        for job_id in [job.id for job in self.jobs.values() if job.finished and now - job.finished > self.retention]:
+            del self.jobs[job_id]
+
+    def for_user(self, user_id):
+        self._prune()
+        return [job for job in self.jobs.values() if job.user_id == user_id]
+
+    def get(self, user_id, job_id):
+        self._prune()
+        job = self.jobs.get(job_id)
+        return job if job is not None and job.user_id == user_id else None
+
+    async def submit(self, bot, chat_id, user_id, title, work):
+        """Ставит work(job) в очередь; ValueError, если у пользователя слишком много задач."""
+        if sum(job.active for job in self.for_user(user_id)) >= self.max_per_user:
+            raise ValueError(f"Уже выполняется задач: {self.max_per_user}. Дождитесь их или отмените: /cancel_job")
+        job = Job(next(self._ids), user_id, chat_id, title)
+        self.jobs[job.id] = job
+        try:
+            message = await bot.send_message(chat_id=chat_id, text=job.describe())
+            job.message_id = message.message_id
+        except TelegramError as error:
+            logging.error("Не удалось отправить сообщение о задаче %s: %s", job.id, error)
+        job.task = asyncio.create_task(self._run(bot, job, work))
+        return job
+
+    async def _edit(self, bot, job):
+        if job.message_id is None:
+            return
+        try:
+            await bot.edit_message_text(job.describe(), chat_id=job.chat_id, message_id=job.message_id)
+        except TelegramError:
+            pass
+
+    async def _progress(self, bot, job):
+        shown = None
+        while True:
+            await asyncio.sleep(JOB_PROGRESS_INTERVAL)
+            if job.lines != shown:
+                shown = job.lines
+                await self._edit(bot, job)
+
+    async def _run(self, bot, job, work):
+        try:
+            async with self._semaphore:
+                job.status = JOB_RUNNING
+                await self._edit(bot, job)
+                progress = asyncio.create_task(self._progress(bot, job))
+                try:
+                    result = await work(job)
+                finally:
+                    progress.cancel()
+                # После отмены удаленная команда завершается раньше, чем прерывается задача.
+                if job.status == JOB_RUNNING:
+                    job.result = result
+                    job.status = JOB_DONE
+        except asyncio.CancelledError:
+            job.status = JOB_CANCELLED
+        except Exception as e:
+            job.status = JOB_FAILED
+            job.result = f"Произошло исключение: {str(e)}"
+        finally:
+            job.finished = time.monotonic()
+            job.remote.clear()
+        await self._edit(bot, job)
+        if job.result is not None:
+            send_result(bot, job)
+
+    async def cancel(self, job):
+        """Завершает удаленные процессы задачи и прерывает ее."""
+        if not job.active:
+            return
+        job.status = JOB_CANCELLED
+
+        async def kill(host, pid):
+            try:
+                await asyncio.wait_for(ssh(f"kill -TERM -{pid}", host=host, label="job_cancel"), FANOUT_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning("Хост %s не ответил на отмену задачи %s за %g с", host, job.id, FANOUT_TIMEOUT)
+
+        # Недоступный хост не должен задерживать отмену на остальных и очередь чата.
+        await asyncio.gather(*(kill(host, pid) for host, pid in list(job.remote.items())))
+        job.task.cancel()
+
+    async def close(self, timeout=5.0):
+        """Отменяет активные задачи и дает им время сообщить об отмене."""
+        active = [job for job in self.jobs.values() if job.active]
+        await asyncio.gather(*(self.cancel(job) for job in active), return_exceptions=True)
+        tasks = [job.task for job in active if job.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+
+job_manager = None
+
+
+def get_job_manager():
+    global job_manager
+    if job_manager is None:
+        job_manager = JobManager(JOB_MAX_TOTAL, JOB_MAX_PER_USER, JOB_RETENTION)
+    return job_manager
+
+
+def send_result(bot, job):
+    """Отправляет результат задачи текстом, а большой — файлом."""
+    if len(job.result) > STREAM_DOCUMENT_THRESHOLD:
+        send_scheduler.enqueue(bot, job.chat_id, text=f"Результат задачи #{job.id}",
+                               document=io.BytesIO(job.result.encode()), filename=f"job_{job.id}.txt")
+    else:
+        send_scheduler.enqueue(bot, job.chat_id, job.result or "Команда ничего не вывела.")
+
+
+async def job_ssh(job, command, host=None, label=None):
+    """Выполняет команду задачи построчно, запоминая номер удаленной группы процессов."""
+    host = host or default_host()
+    lines = []
+    # Без явного label в метриках была бы обертка setsid, а не сама команда.
+    label = label or command.split()[0]
+    async for line in ssh_stream(JOB_WRAPPER.format(command=shlex.quote(command)), JOB_TIMEOUT, host, label):
+        if host not in job.remote and line.startswith("@@pid "):
+            job.remote[host] = int(line[len("@@pid "):])
+        elif is_ssh_error(line):
+            return line
         else:
-            await conn.execute(query, *args) if args else await conn.execute(query)
-            result = True
-        
+            lines.append(line)
+            job.lines += 1
+    job.remote.pop(host, None)
+    return "\n".join(lines) + "\n"
+
+
+def wants_background(context) -> bool:
+    return any(arg.lower() == "bg" for arg in context.args or [])
+
+
+def wants_diff(context) -> bool:
+    return any(arg.lower() == "diff" for arg in context.args or [])
+
+
+DELTA_TTL = float(os.getenv("DELTA_TTL", "86400"))
+# Последний разобранный снимок по (чат, хост, команда) для режима diff.
+delta_snapshots = TTLCache(maxsize=int(os.getenv("DELTA_CACHE_SIZE", "256")))
+
+
+async def submit_job(update: Update, context: CallbackContext, work) -> None:
+    title = update.message.text.split()[0] if update.message and update.message.text else "задача"
+    try:
+        await get_job_manager().submit(context.bot, update.effective_chat.id, update.effective_user.id, title, work)
+    except ValueError as error:
+        reply_later(update, context, str(error))
+
+
+async def run_collector(update: Update, context: CallbackContext, build, parse, render, empty_text, cached=False,
+                        background=False, delta=None) -> None:
+    """Выполняет сборщик из collectors на выбранных хостах и отправляет записи.
+
+    С background или аргументом bg команда выполняется фоновой задачей. Если
+    задан delta (collectors.DeltaSpec), снимок запоминается для чата и хоста, а
+    с аргументом diff отправляются только изменения с прошлого вызова.
+    """
+    selected = select_hosts(update, context)
+    if selected is None:
+        return
+    hosts, args = selected
+    try:
+        command, options = build(args)
+    except ValueError as error:
+        reply_later(update, context, str(error))
+        return
+    # Метка метрик — имя сборщика (ps, services, ...), а не первое слово команды.
+    label = build.__name__.removesuffix("_command")
+    diff = delta is not None and wants_diff(context)
+    # Сравнивать с кэшированным выводом бессмысленно: diff всегда читает заново.
+    refresh = wants_refresh(context) or diff
+    chat_id = update.effective_chat.id
+
+    async def produce(host, job=None):
+        if job is not None:
+            output = await job_ssh(job, command, host, label)
+        elif cached:
+            output = await cached_ssh(command, refresh=refresh, host=host, label=label)
+        else:
+            output = await ssh(command, host=host, label=label)
+        if is_ssh_error(output):
+            return output
+        records = parse(output, **options)
+        if delta is not None:
+            key = (chat_id, host, command)
+            previous = delta_snapshots.get(key)
+            delta_snapshots.set(key, (datetime.now(), records), DELTA_TTL)
+            if diff and previous is not None:
+                return collectors.format_delta(previous[1], records, delta, previous[0])
+        return "\n".join(render(record) for record in records) or empty_text
+
+    if background or wants_background(context):
+        await submit_job(update, context,
+                         lambda job: gather_hosts(hosts, lambda host: produce(host, job), JOB_TIMEOUT))
+        return
+    await fan_out(update, context, hosts, produce)
+
+
+def parse_job_id(context):
+    args = context.args or []
+    return int(args[0].lstrip("#")) if args and args[0].lstrip("#").isdigit() else None
+
+
+async def list_jobs(update: Update, context: CallbackContext) -> None:
+    """/jobs — задачи пользователя за время хранения результатов."""
+    jobs = get_job_manager().for_user(update.effective_user.id)
+    reply_later(update, context, "\n".join(job.describe() for job in jobs) or "Задач нет.")
+
+
+async def job_result(update: Update, context: CallbackContext) -> None:
+    """/job <номер> — состояние задачи и повторная отправка ее результата."""
+    job_id = parse_job_id(context)
+    job = get_job_manager().get(update.effective_user.id, job_id) if job_id else None
+    if job is None:
+        reply_later(update, context, "Задача не найдена. Список задач: /jobs")
+        return
+    reply_later(update, context, job.describe())
+    if job.result is not None:
+        send_result(context.bot, job)
+
+
+async def cancel_job(update: Update, context: CallbackContext) -> None:
+    """/cancel_job [номер] — отменяет задачу или все задачи пользователя."""
+    manager = get_job_manager()
+    job_id = parse_job_id(context)
+    if job_id:
+        job = manager.get(update.effective_user.id, job_id)
+        jobs = [job] if job is not None else []
+    else:
+        jobs = manager.for_user(update.effective_user.id)
+    jobs = [job for job in jobs if job.active]
+    if not jobs:
+        reply_later(update, context, "Нет выполняющихся задач.")
+        return
+    for job in jobs:
+        await manager.cancel(job)
+    reply_later(update, context, "Отменены задачи: " + ", ".join(f"#{job.id}" for job in jobs))
+
+
+db_pool = None
+db_pool_lock = asyncio.Lock()
+db_stats = {"queries": 0, "errors": 0, "acquire_wait": 0.0, "max_acquire_wait": 0.0, "query_time": 0.0}
+
+
+async def get_db_pool():
+    """Возвращает общий пул соединений asyncpg, создавая его при первом обращении."""
+    global db_pool
+    async with db_pool_lock:
+        if db_pool is None:
+            db_pool = await asyncpg.create_pool(
+                user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASSWORD"),
+                host=os.getenv("DB_HOST"),
+                port=os.getenv("DB_PORT"),
+                database=os.getenv("DB_DATABASE"),
+                min_size=int(os.getenv("DB_POOL_MIN", "1")),
+                max_size=int(os.getenv("DB_POOL_MAX", "10")),
+                # Подготовленные выражения кэшируются на каждом соединении пула.
+                statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE", "100")),
+            )
+    return db_pool
+
+
+def db_pool_stats() -> dict:
+    """Статистика пула: размер, ожидание соединения и время запросов."""
+    stats = dict(db_stats)
+    queries = stats["queries"] or 1
+    stats["avg_acquire_wait"] = stats["acquire_wait"] / queries
+    stats["avg_query_time"] = stats["query_time"] / queries
+    if db_pool is not None:
+        stats["pool_size"] = db_pool.get_size()
+        stats["pool_idle"] = db_pool.get_idle_size()
+    return stats
+
+
+async def db_query(query: str, args=None, fetch=True):
+    started = time.perf_counter()
+    failed = True
+    try:
+        pool = await get_db_pool()
+        started = time.perf_counter()
+        async with pool.acquire() as conn:
+            acquired = time.perf_counter()
+            wait = acquired - started
+            db_stats["acquire_wait"] += wait
+            db_stats["max_acquire_wait"] = max(db_stats["max_acquire_wait"], wait)
+            if fetch:
+                result = await conn.fetch(query, *args) if args else await conn.fetch(query)
+            else:
+                await conn.execute(query, *args) if args else await conn.execute(query)
+                result = True
+            db_stats["query_time"] += time.perf_counter() - acquired
+            db_stats["queries"] += 1
+
+        failed = False
         return result
     except Exception as error:
+        db_stats["errors"] += 1
         print(f"Ошибка при работе с PostgreSQL: {error}")
-        return False  
+        return False
     finally:
-        if conn:
-            await conn.close()
-    
+        metrics.observe("db", query.split()[0].upper(), time.perf_counter() - started, failed)
+
+
+async def ensure_indexes() -> None:
+    """Создает уникальные индексы, на которые опираются пакетные проверки и вставки."""
+    await db_query("CREATE UNIQUE INDEX IF NOT EXISTS phone_numbers_phone_number_key ON phone_numbers (phone_number)", fetch=False)
+    await db_query("CREATE UNIQUE INDEX IF NOT EXISTS email_addresses_email_key ON email_addresses (email)", fetch=False)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE)-> None:
     user = update.effective_user
-    await update.message.reply_text(f'Привет, {user.full_name}! Чтобы узнать, что умеет бот, введите /help')
+    reply_later(update, context, f'Привет, {user.full_name}! Чтобы узнать, что умеет бот, введите /help')
     
 async def help_command(update: Update, context):
     logging.info('Команда /help')
-    await update.message.reply_text('В данном боте вы можете воспользоваться следующими командами: \
+    reply_later(update, context, 'В данном боте вы можете воспользоваться следующими командами: \
     \n/find_email - Поиск email-адреса в сообщении\
     \n/find_phone_number - Поиск мобильных номеров в сообщении\
     \n/verify_password - Проверка сложности пароля\
@@ -91,42 +1109,78 @@ async def help_command(update: Update, context):
     \n/get_free - Состояние оперативной памяти подключенной ОС по SSH\
     \n/get_mpstat - Информация о производительности подключенной ОС по SSH\
     \n/get_w - Работающие пользователи в подключенной ОС по SSH\
-    \n/get_auths - 10 последних вошедших пользователей подключенной ОС по SSH\
-    \n/get_critical - 5 последних критических событий подключенной ОС по SSH\
-    \n/get_ps - Запущенные процессы подключенной ОС по SSH\
-    \n/get_ss - Работающие порты подключенной ОС по SSH\
+    \n/get_trend <disk|mem|swap|cpu|load|users> [часы] - Изменение метрик хоста за период (по умолчанию 24 ч)\
+    \n/get_auths [пользователь] [N] - 10 последних вошедших пользователей подключенной ОС по SSH\
+    \n/get_critical [N] - 5 последних критических событий подключенной ОС по SSH\
+    \n/get_ps [cpu|mem] [пользователь] [N] - Топ запущенных процессов подключенной ОС по SSH\
+    \n/get_ss [tcp|udp] [listen|состояние] [N] - Работающие порты подключенной ОС по SSH\
     \n/get_apt_list - Информация о загруженных пакетах  и поиск пакетов на подключенной ОС по SSH\
-    \n/get_services - Работающие сервисы на подключенной ОС по SSH\
-    \n/get_repl_logs - Возвращает логи репликации БД\
-    \n/get_emails - Выводит таблицу номеров из БД\
-    \n/get_phone_numbers - Выводит таблицу номеров из БД')
+    \n/get_services [состояние] [шаблон] [N] - Работающие сервисы на подключенной ОС по SSH\
+    \n/get_repl_logs [N|follow|stop] - Последние события репликации БД или подписка на новые\
+    \n/get_emails [домен] - Выводит таблицу email-адресов из БД постранично\
+    \n/get_phone_numbers [префикс] - Выводит таблицу номеров из БД постранично\
+    \n/export_emails, /export_phones - Выгрузка таблицы email-адресов или номеров в CSV\
+    \n/import_emails, /import_phones - Загрузка email-адресов или номеров из CSV-файла\
+    \n/stats - Статистика задержек бота (для администраторов)\
+    \n/hosts - Список хостов и групп\
+    \n/jobs, /job <номер>, /cancel_job [номер] - Фоновые задачи: список, результат, отмена\
+    \n\nКоманды /get_* (кроме /get_apt_list и /get_repl_logs) принимают цель @хост, @группа или @all.\
+    \n/get_critical, /get_auths, /get_ps, /get_ss и /get_services с аргументом bg выполняются фоновой задачей; /get_critical — всегда.\
+    \n/get_ps, /get_ss и /get_services с аргументом diff показывают только изменения с прошлого вызова в этом чате.\
+    \n/get_uptime, /get_df, /get_free, /get_mpstat и /get_w отвечают из периодического снимка хоста, \
+а результаты /get_release, /get_uname и /get_services кэшируются; добавьте refresh, чтобы обновить их.')
 
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE)-> None:
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=update.message.text)
+    reply_later(update, context, update.message.text)
+
+UPLOAD_FILTER = (filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv")
+                 | filters.Document.FileExtension("log"))
+scan_pool = None
+
+
+def get_scan_pool():
+    global scan_pool
+    if scan_pool is None:
+        scan_pool = ProcessPoolExecutor(max_workers=int(os.getenv("SCAN_WORKERS", "2")))
+    return scan_pool
+
+
+async def extract_from_message(message):
+    """Извлекает контакты из текста сообщения или из загруженного файла.
+
+    Файл сохраняется во временный каталог и сканируется порциями в отдельном
+    процессе, чтобы разбор больших файлов не блокировал цикл событий.
+    """
+    if message.document is None:
+        return extract_contacts(message.text)
+    file = await message.document.get_file()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = await file.download_to_drive(Path(tmp) / "upload")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_scan_pool(), extract_from_file, str(path))
+
 
 FIND_PHONE, CONFIRM_PHONE = range(2)
 async def find_phone_numbersCommand (update:Update, context: ContextTypes.DEFAULT_TYPE)-> None:
-    await update.message.reply_text('Введите текст для поиска телефонных номеров: ')
+    reply_later(update, context, 'Введите текст или отправьте файл .txt/.csv/.log для поиска телефонных номеров: ')
     return FIND_PHONE
 
 async def find_phone_number(update: Update, context: CallbackContext) -> int:
-    text = update.message.text
-    phone_regex = re.compile(r'(?:\+7|8)[- ]?(?:\(\d{3}\)|\d{3})[- ]?\d{3}[- ]?\d{2}[- ]?\d{2}')
-    found_numbers = phone_regex.findall(text)
+    contacts = await extract_from_message(update.message)
+    found_numbers = contacts.phones
 
     if not found_numbers:
-        await update.message.reply_text("Телефонные номера не найдены.")
+        reply_later(update, context, "Телефонные номера не найдены.")
         return ConversationHandler.END
-    
-    formatted_existing_numbers = [format_phone_number(num) for num in found_numbers]
-    existing_numbers = await check_existing_numbers(formatted_existing_numbers)
-    new_numbers = [num for num in found_numbers if format_phone_number(num) not in existing_numbers]
+
+    existing_numbers = set(await check_existing_numbers(found_numbers))
+    new_numbers = [num for num in found_numbers if num not in existing_numbers]
 
     if not new_numbers:
-        await update.message.reply_text("Все найденные номера уже сохранены в базе данных.")
+        reply_later(update, context, "Все найденные номера уже сохранены в базе данных.")
         return ConversationHandler.END
 
-    message_lines = [f"{i + 1}. {num}" for i, num in enumerate(found_numbers)]
+    message_lines = [f"{i + 1}. {num}" for i, num in enumerate(new_numbers)]
     message = "Уникальные номера телефонов которых нет в базе:\n" + "\n".join(message_lines)
     context.user_data['data_to_save'] = new_numbers
 
@@ -136,40 +1190,122 @@ async def find_phone_number(update: Update, context: CallbackContext) -> int:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(message, reply_markup=reply_markup)
+    reply_later(update, context, message, reply_markup)
     return CONFIRM_PHONE
 
-async def check_existing_numbers(numbers):
+class ContactIndex:
+    """Индекс известных контактов в памяти процесса.
+
+    Хранит хэши нормализованных значений: промах по индексу означает, что
+    значения в БД точно нет, а совпадение подтверждается запросом к БД, так как
+    хэши могут совпасть, а строку мог удалить другой экземпляр бота.
+    """
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+        self.loaded = False
+        self._hashes = set()
+        self._last_id = 0
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, values):
+        self._hashes.update(hash(value) for value in values)
+
+    async def refresh(self, full=False):
+        """Догружает строки, добавленные после последней загрузки; full=True перестраивает индекс."""
+        hashes, last_id = (set(), 0) if full else (self._hashes, self._last_id)
+        query = f"SELECT id, {self.column} FROM {self.table} WHERE id > $1 ORDER BY id"
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                async for record in conn.cursor(query, last_id, prefetch=10000):
+                    hashes.add(hash(record[1]))
+                    last_id = record[0]
+        self._hashes, self._last_id = hashes, last_id
+        self.loaded = True
+
+    async def existing(self, values, lookup):
+        """Возвращает уже сохраненные значения, обращаясь к БД только при совпадениях в индексе."""
+        if not self.loaded:
+            return await lookup(values)
+        candidates = [value for value in values if hash(value) in self._hashes]
+        if not candidates:
+            return []
+        return await lookup(candidates)
+
+
+phone_index = ContactIndex("phone_numbers", "phone_number")
+email_index = ContactIndex("email_addresses", "email")
+CONTACT_INDEX_REFRESH = float(os.getenv("CONTACT_INDEX_REFRESH", "60"))
+# id выделяются до фиксации, и строки долгой транзакции (например, импорта на
+# другом экземпляре) могут появиться ниже уже загруженного id. Догрузка по id их
+# не видит, поэтому раз в CONTACT_INDEX_REBUILD секунд индекс строится заново.
+CONTACT_INDEX_REBUILD = float(os.getenv("CONTACT_INDEX_REBUILD", "3600"))
+contact_index_task = None
+
+
+async def refresh_contact_indexes(full=False) -> None:
+    for index in (phone_index, email_index):
+        try:
+            await index.refresh(full)
+        except Exception as error:
+            logging.error("Ошибка при загрузке индекса %s: %s", index.table, error)
+
+
+async def contact_index_refresher() -> None:
+    """Периодически подгружает контакты, добавленные другими экземплярами бота,
+    и раз в CONTACT_INDEX_REBUILD секунд перестраивает индексы целиком."""
+    rebuilt_at = time.monotonic()
+    while True:
+        await asyncio.sleep(CONTACT_INDEX_REFRESH)
+        full = time.monotonic() - rebuilt_at >= CONTACT_INDEX_REBUILD
+        await refresh_contact_indexes(full)
+        if full:
+            rebuilt_at = time.monotonic()
+
+
+async def query_existing_numbers(numbers):
     existing_numbers = []
     try:
-        for number in numbers:
-            query = "SELECT phone_number FROM phone_numbers WHERE phone_number = $1"
-            result = await db_query(query, args=(number,), fetch=True)
-            if result:
-                existing_numbers.append(number)
+        query = "SELECT phone_number FROM phone_numbers WHERE phone_number = ANY($1::text[])"
+        result = await db_query(query, args=(list(numbers),), fetch=True)
+        if result:
+            existing_numbers = [record['phone_number'] for record in result]
     except Exception as e:
         print(f"Ошибка при проверке существующих номеров: {e}")
     return existing_numbers
 
-def format_phone_number(number):
-    digits = re.sub(r'\D', '', number)
-    if digits.startswith('8'):
-        formatted = f"8 ({digits[1:4]}) {digits[4:7]}-{digits[7:9]}-{digits[9:11]}"
-    elif digits.startswith('7'):
-        formatted = f"+7 ({digits[1:4]}) {digits[4:7]}-{digits[7:9]}-{digits[9:11]}"
-    else:
-        formatted = number
-    return formatted
+async def check_existing_numbers(numbers):
+    return await phone_index.existing(numbers, query_existing_numbers)
+
+async def bulk_insert(table, column, values):
+    """Вставляет значения одним запросом, пропуская уже существующие.
+
+    Возвращает пару (вставлено, пропущено) или False при ошибке.
+    """
+    values = list(dict.fromkeys(values))
+    query = (
+        f"INSERT INTO {table} ({column}) "
+        f"SELECT v FROM unnest($1::text[]) AS v "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {column} = v) "
+        f"ON CONFLICT DO NOTHING RETURNING {column}"
+    )
+    result = await db_query(query, args=(values,), fetch=True)
+    if result is False:
+        return False
+    return len(result), len(values) - len(result)
 
 async def save_data(data):
-    query = "INSERT INTO phone_numbers (phone_number) VALUES ($1)"
     try:
-        for item in data:
-            formatted_number = format_phone_number(item)
-            result = await db_query(query, args=(formatted_number,), fetch=False)
-            if not result:
-                raise Exception("Failed to insert data")
-        return True
+        numbers = [format_phone_number(item) for item in data]
+        result = await bulk_insert("phone_numbers", "phone_number", numbers)
+        if result is False:
+            raise Exception("Failed to insert data")
+        phone_index.add(numbers)
+        return result
     except Exception as e:
         print(f"Произошла ошибка при сохранении данных: {e}")
         return False
@@ -182,7 +1318,8 @@ async def button_handler(update: Update, context: CallbackContext) -> int:
         if data_to_save:
             result = await save_data(data_to_save)
             if result:
-                await query.edit_message_text("Телефонные номера сохранены!")
+                inserted, skipped = result
+                await query.edit_message_text(f"Телефонные номера сохранены! Добавлено: {inserted}, пропущено: {skipped}")
             else:
                 await query.edit_message_text("Ошибка сохранения данных")
         else:
@@ -193,7 +1330,8 @@ async def button_handler(update: Update, context: CallbackContext) -> int:
         if emails_to_save:
             result = await save_emails(emails_to_save)
             if result:
-                await query.edit_message_text("Email-адреса сохранены!")
+                inserted, skipped = result
+                await query.edit_message_text(f"Email-адреса сохранены! Добавлено: {inserted}, пропущено: {skipped}")
             else:
                 await query.edit_message_text("Ошибка при сохранении email-адресов")
         else:
@@ -206,23 +1344,22 @@ async def button_handler(update: Update, context: CallbackContext) -> int:
 
 FIND_EMAIL, CONFIRM_EMAIL = range(2)   
 async def find_emailCommand(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text('Введите текст для поиска email-адресов: ')
+    reply_later(update, context, 'Введите текст или отправьте файл .txt/.csv/.log для поиска email-адресов: ')
     return FIND_EMAIL
 
 async def find_email(update: Update, context: CallbackContext) -> int:
-    user_input = update.message.text
-    emailRegex = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
-    email_list = emailRegex.findall(user_input)
+    contacts = await extract_from_message(update.message)
+    email_list = contacts.emails
 
     if not email_list:
-        await update.message.reply_text('Email-адреса не найдены')
+        reply_later(update, context, 'Email-адреса не найдены')
         return ConversationHandler.END
 
-    existing_emails = await check_existing_emails(email_list)
+    existing_emails = set(await check_existing_emails(email_list))
     new_emails = [email for email in email_list if email not in existing_emails]
 
     if not new_emails:
-        await update.message.reply_text('Все найденные email-адреса уже сохранены.')
+        reply_later(update, context, 'Все найденные email-адреса уже сохранены.')
         return ConversationHandler.END
 
     message_lines = [f"{i + 1}. {email}" for i, email in enumerate(new_emails)]
@@ -234,40 +1371,38 @@ async def find_email(update: Update, context: CallbackContext) -> int:
          InlineKeyboardButton("Отмена", callback_data='cancel')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(message, reply_markup=reply_markup)
+    reply_later(update, context, message, reply_markup)
     return CONFIRM_EMAIL
 
-async def check_existing_emails(emails):
+async def query_existing_emails(emails):
     existing_emails = []
     try:
-        for email in emails:
-            query = "SELECT email FROM email_addresses WHERE email = $1"
-            result = await db_query(query, args=(email,), fetch=True)
-            if result:
-                existing_emails.extend([record['email'] for record in result])
+        query = "SELECT email FROM email_addresses WHERE email = ANY($1::text[])"
+        result = await db_query(query, args=(list(emails),), fetch=True)
+        if result:
+            existing_emails = [record['email'] for record in result]
     except Exception as e:
         print(f"Ошибка при проверке существующих email-адресов: {e}")
     return existing_emails
 
+async def check_existing_emails(emails):
+    return await email_index.existing(emails, query_existing_emails)
+
 async def save_emails(emails):
-    query = "INSERT INTO email_addresses (email) VALUES ($1)"
     try:
-        for email in emails:
-            existing_emails = await check_existing_emails([email])
-            if not existing_emails:
-                result = await db_query(query, args=(email,), fetch=False)
-                if not result:
-                    raise Exception(f"Ошибка добавления email: {email}")
-        return True
+        result = await bulk_insert("email_addresses", "email", emails)
+        if result is False:
+            raise Exception("Ошибка добавления email-адресов")
+        email_index.add(emails)
+        return result
     except Exception as e:
+        print(f"Произошла ошибка при сохранении email-адресов: {e}")
         return False
 
 ASK_PASSWORD = 1
 async def verify_password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Запускает диалог для проверки сложности пароля."""
-    await update.message.reply_text(
-        "Пожалуйста, введите пароль. Чтобы выйти из проверки, отправьте команду /cancel."
-    )
+    reply_later(update, context, "Пожалуйста, введите пароль. Чтобы выйти из проверки, отправьте команду /cancel.")
     return ASK_PASSWORD
 
 async def check_password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -275,256 +1410,836 @@ async def check_password(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     password = update.message.text
 
     if re.match(r'^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[!@#$%^&*()]).{8,}$', password):
-        await update.message.reply_text("Пароль сложный")
+        reply_later(update, context, "Пароль сложный")
     else:
-        await update.message.reply_text("Пароль простой")
+        reply_later(update, context, "Пароль простой")
 
     return ASK_PASSWORD
 
 async def get_release(update: Update, context: CallbackContext) -> None:
-    command = "cat /etc/os-release"
-    
-    release_info = ssh(command)
-  
-    await update.message.reply_text(release_info)
+    await run_command(update, context, "cat /etc/os-release")
 
 async def get_uname(update: Update, context: CallbackContext) -> None:
-    command = "uname -a"
-    
-    system_info = ssh(command)
+    await run_command(update, context, "uname -a")
+
+HOST_METRICS_INTERVAL = float(os.getenv("HOST_METRICS_INTERVAL", "60"))
+HOST_METRICS_RETENTION_DAYS = int(os.getenv("HOST_METRICS_RETENTION_DAYS", "30"))
+TREND_BUCKETS = 12
+TREND_METRICS = {
+    "disk": ("disk", "%"),
+    "mem": ("mem", "%"),
+    "swap": ("swap", "%"),
+    "cpu": ("cpu", "%"),
+    "load": ("load1", ""),
+    "users": ("users", ""),
+}
+host_snapshots = {}
+host_metrics_task = None
+
+
+async def ensure_host_metrics_table() -> None:
+    """Таблица временных рядов: одна строка на значение метрики хоста в момент снимка."""
+    await db_query("CREATE TABLE IF NOT EXISTS host_metrics (ts timestamptz NOT NULL, host text NOT NULL, "
+                   "metric text NOT NULL, label text NOT NULL DEFAULT '', value real NOT NULL)", fetch=False)
+    await db_query("CREATE INDEX IF NOT EXISTS host_metrics_host_metric_ts_idx ON host_metrics (host, metric, ts)",
+                   fetch=False)
+
+
+async def collect_host_snapshot(host):
+    """Снимает состояние хоста одной SSH-командой."""
+    output = await ssh(collectors.host_snapshot_command(), host=host, label="host_snapshot")
+    if is_ssh_error(output):
+        logging.warning("Не удалось снять состояние хоста %s: %s", host, output)
+        return None
+    snapshot = collectors.parse_host_snapshot(output, datetime.now(timezone.utc))
+    host_snapshots[host] = snapshot
+    return snapshot
+
+
+async def collect_host_snapshots() -> None:
+    """Снимает состояние всех хостов и сохраняет их метрики одним запросом."""
+    hosts = list(get_inventory())
+    semaphore = asyncio.Semaphore(FANOUT_LIMIT)
+
+    async def collect(host):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(collect_host_snapshot(host), FANOUT_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning("Хост %s не ответил за %g с", host, FANOUT_TIMEOUT)
+                return None
+
+    rows = []
+    for host, snapshot in zip(hosts, await asyncio.gather(*(collect(host) for host in hosts))):
+        if snapshot is not None:
+            rows.extend((snapshot.taken_at, host, *sample) for sample in snapshot.samples)
+    if rows:
+        await db_query("INSERT INTO host_metrics (ts, host, metric, label, value) "
+                       "SELECT * FROM unnest($1::timestamptz[], $2::text[], $3::text[], $4::text[], $5::real[])",
+                       args=[list(column) for column in zip(*rows)], fetch=False)
+
+
+async def host_metrics_collector() -> None:
+    """Периодически снимает состояние хостов и раз в час удаляет устаревшие точки."""
+    pruned_at = 0.0
+    while True:
+        try:
+            await collect_host_snapshots()
+        except (OSError, ValueError) as error:
+            logging.error("Ошибка загрузки списка хостов: %s", error)
+        if time.monotonic() - pruned_at > 3600:
+            await db_query("DELETE FROM host_metrics WHERE ts < now() - $1::int * interval '1 day'",
+                           args=(HOST_METRICS_RETENTION_DAYS,), fetch=False)
+            pruned_at = time.monotonic()
+        await asyncio.sleep(HOST_METRICS_INTERVAL)
+
+
+async def reply_host_section(update: Update, context: CallbackContext, section, command) -> None:
+    """Отвечает из последнего снимка хоста; без свежего снимка или с refresh выполняет команду."""
+    selected = select_hosts(update, context)
+    if selected is None:
+        return
+    hosts, _ = selected
+    refresh = wants_refresh(context)
+
+    async def produce(host):
+        snapshot = host_snapshots.get(host)
+        if (snapshot is not None and not refresh
+                and (datetime.now(timezone.utc) - snapshot.taken_at).total_seconds() < 2 * HOST_METRICS_INTERVAL):
+            taken_at = snapshot.taken_at.astimezone()
+            return f"Данные на {taken_at:%H:%M:%S}:\n{snapshot.sections.get(section, '')}"
+        return await cached_ssh(command, refresh=refresh, host=host)
+
+    await fan_out(update, context, hosts, produce)
 
-    await update.message.reply_text(system_info)
 
 async def get_uptime(update: Update, context: CallbackContext) -> None:
-    command = "uptime"
-    uptime_info = ssh(command)
-
-    await update.message.reply_text(uptime_info)
+    await reply_host_section(update, context, "uptime", "uptime")
 
 async def get_df(update: Update, context: CallbackContext) -> None:
-    command = "df -h"
-
-    df_info = ssh(command)
-
-    await update.message.reply_text(df_info)
-  
+    await reply_host_section(update, context, "df", "df -h")
 
 async def get_free(update: Update, context: CallbackContext) -> None:
-    command = "free -h"
-    
-    free_info = ssh(command)
- 
-    await update.message.reply_text(free_info)
+    await reply_host_section(update, context, "free", "free -h")
 
 async def get_mpstat(update: Update, context: CallbackContext) -> None:
-    command = "mpstat"
-  
-    mpstat_info = ssh(command)
-   
-    await update.message.reply_text(mpstat_info)
+    await reply_host_section(update, context, "mpstat", "mpstat")
 
 async def get_w(update: Update, context: CallbackContext) -> None:
-    command = "w"
- 
-    w_info = ssh(command)
-
-    await update.message.reply_text(w_info)
+    await reply_host_section(update, context, "w", "w")
+
+async def get_trend(update: Update, context: CallbackContext) -> None:
+    """/get_trend <disk|mem|swap|cpu|load|users> [часы]: средние и максимумы по интервалам."""
+    selected = select_hosts(update, context)
+    if selected is None:
+        return
+    hosts, args = selected
+    if not args or args[0].lower() not in TREND_METRICS or (len(args) > 1 and not args[1].isdigit()):
+        reply_later(update, context, f"Использование: /get_trend <{'|'.join(TREND_METRICS)}> [часы] [@хост]")
+        return
+    metric, unit = TREND_METRICS[args[0].lower()]
+    hours = min(int(args[1]) if len(args) > 1 else 24, HOST_METRICS_RETENTION_DAYS * 24) or 1
+    bucket = hours * 3600 // TREND_BUCKETS
+
+    async def produce(host):
+        rows = await db_query(
+            "SELECT label, to_timestamp(floor(extract(epoch FROM ts) / $4::int) * $4::int) AS bucket, "
+            "avg(value) AS avg, max(value) AS max FROM host_metrics "
+            "WHERE host = $1 AND metric = $2 AND ts > now() - $3::int * interval '1 hour' "
+            "GROUP BY label, bucket ORDER BY label, bucket",
+            args=(host, metric, hours, bucket))
+        if rows is False:
+            return "Ошибка при получении данных из базы данных."
+        if not rows:
+            return f"Нет данных за последние {hours} ч."
+        lines = []
+        for label, group in itertools.groupby(rows, key=lambda row: row["label"]):
+            group = list(group)
+            peak = max(row["max"] for row in group)
+            lines.append(f"{label or args[0].lower()} за {hours} ч, максимум {peak:.1f}{unit}:")
+            for row in group:
+                lines.append(f"{row['bucket'].astimezone():%m-%d %H:%M}  ср {row['avg']:.1f}{unit}  макс {row['max']:.1f}{unit}")
+        return "\n".join(lines)
+
+    await fan_out(update, context, hosts, produce)
+
+
+async def list_hosts(update: Update, context: CallbackContext) -> None:
+    """/hosts — хосты из инвентаря и их группы."""
+    try:
+        hosts = get_inventory()
+    except (OSError, ValueError) as error:
+        reply_later(update, context, f"Ошибка загрузки списка хостов: {error}")
+        return
+    default = default_host()
+    reply_later(update, context, "\n".join(
+        f"{name}{' (по умолчанию)' if name == default else ''}: {config.host}:{config.port}"
+        + (f" [{', '.join(config.groups)}]" if config.groups else "")
+        for name, config in hosts.items()))
 
 async def get_auths(update: Update, context: CallbackContext) -> None:
-    command = "last -i -n 10"
-    auths_info = ssh(command)
-
-    results = []
-    for line in auths_info.splitlines():
-        parts = line.split()
-        
-        if len(parts) < 5:
-            continue
-        user = parts[0]
-        if user == "reboot" or user == "shutdown":
-            
-            kernel_version = parts[2]
-            date_time_str = " ".join(parts[3:8])
-            results.append(f"Перезагрузка/выключение системы (ядро {kernel_version}): {date_time_str}\n--")
-        else:
-           
-            host = parts[2]
-            date_time_str = " ".join(parts[3:7])  
-            results.append(f"Пользователь: {user}\nIP/Хост: {host}\nВремя: {date_time_str}\n--")
-    formatted_result = "\n".join(results) or "Нет данных о последних авторизациях."
-    await update.message.reply_text(formatted_result)
-    
-async def get_critical(update: Update, context: CallbackContext) -> None: 
-    command = "journalctl -r -p crit -n 5"
+    await run_collector(update, context, collectors.auths_command, collectors.parse_auths,
+                        collectors.format_auth, "Нет данных о последних авторизациях.")
 
-    critical_info = ssh(command)
-    
-    await update.message.reply_text(critical_info)
+async def get_critical(update: Update, context: CallbackContext) -> None:
+    await run_collector(update, context, collectors.critical_command, collectors.parse_journal,
+                        collectors.format_journal, "Нет критических событий.", background=True)
 
 async def get_ps(update: Update, context: CallbackContext) -> None:
-    command = "ps"
-
-    ps_info = ssh(command)
-   
-    await update.message.reply_text(ps_info)
+    await run_collector(update, context, collectors.ps_command, collectors.parse_ps,
+                        collectors.format_process, "Нет данных о процессах.", delta=collectors.PROCESS_DELTA)
 
 async def get_ss(update, context) -> None:
-    command = "ss -n"  
-    ss_info = ssh(command)
+    await run_collector(update, context, collectors.ss_command, collectors.parse_ss,
+                        collectors.format_socket, "Нет данных о текущих портах.", delta=collectors.SOCKET_DELTA)
 
-    results = []
-    for line in ss_info.splitlines():
-        parts = line.split()
+    return ConversationHandler.END
 
-        if len(parts) < 5 or parts[0] == "Netid":
-            continue
+DPKG_STATUS = "/var/lib/dpkg/status"
+APT_PAGE_SIZE = int(os.getenv("APT_PAGE_SIZE", "50"))
+
+
+class PackageIndex:
+    """Локальный индекс установленных пакетов хоста: имя -> версия.
+
+    Список перечитывается по SSH только при изменении mtime или размера файла
+    статуса dpkg, а сама проверка выполняется не чаще раза в check_interval
+    секунд; остальные запросы обслуживаются из памяти.
+    """
+
+    def __init__(self, check_interval=30.0):
+        self.check_interval = check_interval
+        self.packages = {}
+        self._names = []
+        self._stamp = None
+        self._checked = 0.0
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, force=False) -> None:
+        async with self._lock:
+            if not force and self._stamp is not None and time.monotonic() - self._checked < self.check_interval:
+                return
+            known = "" if force or self._stamp is None else self._stamp
+            # Одна удаленная команда: отметка файла статуса, а список пакетов — только если она изменилась.
+            command = (f"s=$(stat -c '%Y %s' {DPKG_STATUS}) || exit 1; echo \"$s\"; "
+                       f"[ \"$s\" = '{known}' ] || dpkg-query -W -f='${{binary:Package}}\\t${{Version}}\\n'")
+            stamp = None
+            error = None
+            packages = {}
+            async for line in ssh_stream(command, label="dpkg_index"):
+                if is_ssh_error(line):
+                    error = line
+                elif stamp is None:
+                    stamp = line.strip()
+                else:
+                    name, _, version = line.partition("\t")
+                    if name:
+                        packages[name] = version
+            if error or not stamp:
+                raise RuntimeError(error or "Не удалось получить список пакетов.")
+            if stamp != known:
+                self.packages = packages
+                self._names = sorted(packages)
+            self._stamp = stamp
+            self._checked = time.monotonic()
+
+    def search(self, query):
+        """Точное совпадение, затем пакеты с таким префиксом, затем с подстрокой; all — все пакеты."""
+        if query == "all":
+            return self._names
+        if query in self.packages:
+            return [query]
+        start = bisect.bisect_left(self._names, query)
+        prefixed = []
+        for name in itertools.islice(self._names, start, None):
+            if not name.startswith(query):
+                break
+            prefixed.append(name)
+        return prefixed + [name for name in self._names if query in name and not name.startswith(query)]
+
+
+package_index = PackageIndex(check_interval=float(os.getenv("PACKAGE_INDEX_CHECK", "30")))
+
+
+def render_packages_page(names, page):
+    if not names:
+        return "Информация не найдена.", None
+    pages = (len(names) + APT_PAGE_SIZE - 1) // APT_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    chunk = names[page * APT_PAGE_SIZE:(page + 1) * APT_PAGE_SIZE]
+    lines = [f"{name} {package_index.packages[name]}" for name in chunk]
+    text = f"Пакеты (найдено {len(names)}, стр. {page + 1}/{pages}):\n" + "\n".join(lines)
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀ Назад", callback_data=f"apt:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("Вперед ▶", callback_data=f"apt:{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
 
-        local_address = parts[4] if ":" in parts[4] else None
-        peer_address = parts[5] if len(parts) > 5 and ":" in parts[5] else None
 
-        if local_address is None or peer_address is None:
-            continue
+async def start_get_apt_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    reply_later(update, context,
+                "Введите 'all' для отображения всех пакетов или укажите название пакета (поиск по префиксу и подстроке).")
+    return ASK_PACKAGE
 
-        netid = parts[0]  
-        state = parts[1] 
+async def get_apt_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Получает список установленных пакетов или информацию об одном пакете."""
+    user_input = update.message.text.strip().lower()
 
-        results.append(
-            f"Тип сокета: {netid}\nСостояние: {state}\nЛокальный адрес: {local_address}\nУдаленный адрес: {peer_address}\n--\n"
-        )
+    try:
+        await package_index.refresh()
+    except Exception as error:
+        reply_later(update, context, str(error))
+        return ConversationHandler.END
+    context.user_data["apt_query"] = user_input
+    text, reply_markup = render_packages_page(package_index.search(user_input), 0)
+    reply_later(update, context, text, reply_markup)
 
-    ss_info_formatted = "\n".join(results) or "Нет данных о текущих портах."
+    return ConversationHandler.END
 
-    if len(ss_info_formatted) > MAX_TELEGRAM_MESSAGE_LENGTH:
-        messages = split_message(ss_info_formatted)
-        for msg in messages:
-            await update.message.reply_text(msg)
-    else:
-        await update.message.reply_text(ss_info_formatted)
+async def apt_page_handler(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await query.answer()
+    names = package_index.search(context.user_data.get("apt_query", "all"))
+    text, reply_markup = render_packages_page(names, int(query.data.split(":")[1]))
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def get_services(update: Update, context: CallbackContext) -> None:
+    await run_collector(update, context, collectors.services_command, collectors.parse_services,
+                        collectors.format_service, "Нет данных о текущих сервисах.", cached=True,
+                        delta=collectors.SERVICE_DELTA)
 
     return ConversationHandler.END
 
-async def start_get_apt_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(
-        "Введите 'all' для отображения всех пакетов или укажите название пакета."
-    )
-    return ASK_PACKAGE
+REPL_LOG_GLOB = os.getenv("REPL_LOG_GLOB", "/var/log/postgresql/*")
+REPL_LOG_POLL = float(os.getenv("REPL_LOG_POLL", "10"))
+# При первом чтении берется только хвост каждого файла, а за один опрос читается
+# не больше REPL_LOG_MAX_READ новых байт файла.
+REPL_LOG_INITIAL_BYTES = int(os.getenv("REPL_LOG_INITIAL_BYTES", str(256 * 1024)))
+REPL_LOG_MAX_READ = int(os.getenv("REPL_LOG_MAX_READ", str(4 * 1024 * 1024)))
+MAX_LOG_LINE = 64 * 1024
+
+
+class ReplLogTail:
+    """Инкрементальное чтение логов PostgreSQL по SSH с запоминанием смещений.
+
+    Для каждого файла хранится пара inode -> смещение, и за один SSH-запрос
+    читаются только новые байты всех файлов. Переименованный при ротации файл
+    сохраняет inode и дочитывается, новый файл читается с начала, а усеченный
+    (copytruncate) — заново. Последние события репликации хранятся в кольцевом
+    буфере и рассылаются подписанным чатам.
+    """
+
+    def __init__(self, pattern, buffer_size=200):
+        self.pattern = pattern
+        self.events = deque(maxlen=buffer_size)
+        self.subscribers = set()
+        self._offsets = None
+        self._lock = asyncio.Lock()
+
+    def _command(self):
+        offsets = self._offsets or {}
+        cases = " ".join(f"{inode}) off={offset};;" for inode, offset in offsets.items())
+        default = f"$(($2 > {REPL_LOG_INITIAL_BYTES} ? $2 - {REPL_LOG_INITIAL_BYTES} : 0))" if self._offsets is None else "0"
+        return (
+            f"for f in {self.pattern}; do "
+            f'case "$f" in *.gz) continue;; esac; [ -f "$f" ] && [ -r "$f" ] || continue; '
+            f"set -- $(stat -c '%i %s %Y' \"$f\"); "
+            f"case $1 in {cases} *) off={default};; esac; "
+            f'[ "$off" -gt "$2" ] && off=0; '
+            f"[ $(($2 - off)) -gt {REPL_LOG_MAX_READ} ] && off=$(($2 - {REPL_LOG_MAX_READ})); "
+            f'echo "@@$1 $off $2 $3"; tail -c +$((off + 1)) "$f" | head -c $(($2 - off)); '
+            f"done"
+        )
 
-async def get_apt_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Получает список установленных пакетов или информацию об одном пакете."""
-    user_input = update.message.text.strip().lower()
+    @staticmethod
+    def _parse(output):
+        """Разбирает блоки "@@inode смещение размер mtime" с данными известной длины."""
+        files = []
+        pos = 0
+        while pos < len(output):
+            end = output.find(b"\n", pos)
+            header = output[pos:end].split() if end >= 0 else []
+            if len(header) != 4 or not header[0].startswith(b"@@"):
+                # Файл усекли между stat и чтением: остальное перечитается в следующий раз.
+                return files, False
+            inode, offset, size, mtime = int(header[0][2:]), int(header[1]), int(header[2]), int(header[3])
+            data = output[end + 1:end + 1 + size - offset]
+            pos = end + 1 + len(data)
+            files.append((mtime, inode, offset, data))
+        return files, True
+
+    async def poll(self, bot):
+        """Читает новые строки логов, рассылает найденные события подписчикам и возвращает их."""
+        async with self._lock:
+            command = self._command()
+            started = time.perf_counter()
+            try:
+                output, error = await get_ssh_pool().run(command, raw=True)
+            except Exception as e:
+                return f"Произошло исключение: {str(e)}"
+            finally:
+                metrics.observe("ssh", "repl_tail", time.perf_counter() - started)
+            if error:
+                return f"Ошибка: {error}"
+            files, complete = self._parse(output)
+            offsets = {} if complete else dict(self._offsets or {})
+            events = []
+            # Старые (ротированные) файлы раньше новых, чтобы события шли по порядку.
+            for mtime, inode, offset, data in sorted(files):
+                known = (self._offsets or {}).get(inode)
+                # Чтение началось не там, где закончилось прошлое: первая строка неполная.
+                skip = (data.find(b"\n") + 1 or len(data)) if offset and offset != known else 0
+                end = data.rfind(b"\n") + 1
+                if end <= skip:
+                    end = len(data) if len(data) - skip > MAX_LOG_LINE else skip
+                offsets[inode] = offset + end
+                for line in data[skip:end].decode(errors="replace").splitlines():
+                    if "repl" in line:
+                        events.append(line)
+            self._offsets = offsets
+            self.events.extend(events)
+            # Рассылка здесь, а не в follow: смещения сдвигает и ручной запрос.
+            if events:
+                text = "\n".join(events[-self.events.maxlen:])
+                for chat_id in self.subscribers:
+                    send_scheduler.enqueue(bot, chat_id, text)
+            return events
+
+    async def follow(self, bot):
+        """Опрашивает логи, пока есть подписчики; новые события рассылает poll."""
+        while True:
+            await asyncio.sleep(REPL_LOG_POLL)
+            if not self.subscribers:
+                continue
+            events = await self.poll(bot)
+            if isinstance(events, str):
+                logging.error("Не удалось прочитать логи репликации: %s", events)
+
+
+repl_log = ReplLogTail(REPL_LOG_GLOB, int(os.getenv("REPL_LOG_BUFFER", "200")))
+repl_log_task = None
 
-    if user_input == "all":
-        command = "dpkg-query -W -f='${binary:Package}\n'"
-    else:
-        command = f"dpkg-query -W -f='${{binary:Package}} ${{Version}}\n' {user_input}"
-    apt_info = ssh(command)
 
-    if len(apt_info) > MAX_TELEGRAM_MESSAGE_LENGTH:
-        messages = split_message(apt_info)
-        for msg in messages:
-            await update.message.reply_text(msg)
-    else:
-        await update.message.reply_text(apt_info or "Информация не найдена.")
+async def get_repl_logs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/get_repl_logs [N] — последние события репликации; follow/stop — подписка на новые."""
+    args = [arg.lower() for arg in context.args or []]
+    chat_id = update.effective_chat.id
+    if args[:1] == ["follow"]:
+        repl_log.subscribers.add(chat_id)
+        reply_later(update, context, "Новые события репликации будут приходить в этот чат. Отписаться: /get_repl_logs stop")
+        return ConversationHandler.END
+    if args[:1] == ["stop"]:
+        repl_log.subscribers.discard(chat_id)
+        reply_later(update, context, "Подписка на события репликации отключена.")
+        return ConversationHandler.END
+    limit = int(args[0]) if args and args[0].isdigit() else 10
+    result = await repl_log.poll(context.bot)
+    if isinstance(result, str):
+        reply_later(update, context, result)
+        return ConversationHandler.END
+
+    async def recent():
+        for line in list(repl_log.events)[-limit:]:
+            yield line
 
+    await reply_lines(update, context, recent(), filename="repl_logs.txt",
+                      empty_text="Нет данных о репликации в логах.")
     return ConversationHandler.END
 
-async def get_services(update: Update, context: CallbackContext) -> None:
-    command = "systemctl list-units --type=service --state=running"
 
-    services_info = ssh(command)
-    results = []
-    legend_found = False
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "20"))
+CONTACT_TABLES = {
+    "emails": ("email_addresses", "email", "Email-адреса"),
+    "phones": ("phone_numbers", "phone_number", "Номера телефонов"),
+}
 
-    for line in services_info.splitlines():
-        if line.startswith("UNIT") or not line.strip():
-            continue
 
-        if line.startswith("Legend:"):
-            legend_found = True
-            continue
+def like_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
-        if legend_found:
-            break
 
-        parts = line.split()
-        if len(parts) < 5 or parts[1] == "LOAD":
-            continue
+# Выражение, с которым сравнивается фильтр. Номер сравнивается по цифрам без
+# кода страны, так как 8 и +7 хранятся в том виде, в каком их нашел format_phone_number.
+CONTACT_FILTER_EXPR = {
+    "emails": "lower(email)",
+    "phones": "substr(regexp_replace(phone_number, '\\D', '', 'g'), 2)",
+}
 
-        unit = parts[0]  
-        load = parts[1] 
-        active = parts[2]
-        sub = parts[3]
-        description = " ".join(parts[4:])
 
-        results.append(
-            f"Сервис: {unit}\nЗагрузка: {load}\nСостояние: {active}\nСтатус: {sub}\nИнформация: {description}\n--"
-        )
+def contact_filter_pattern(kind, value):
+    """Шаблон LIKE: для email — домен, для телефонов — префикс номера (8916, +7916 или 916)."""
+    if not value:
+        return None
+    if kind == "emails":
+        return "%@" + like_escape(value.lstrip("@").lower())
+    digits = re.sub(r'\D', '', value)
+    if digits[:1] in ("7", "8"):
+        digits = digits[1:]
+    return digits + "%"
 
-    services_info_formatted = "\n".join(results) or "Нет данных о текущих портах."
-    if len(services_info_formatted) > MAX_TELEGRAM_MESSAGE_LENGTH:
-        messages = split_message(services_info_formatted)
-        for msg in messages:
-            await update.message.reply_text(msg)
+
+async def fetch_contacts_page(kind, cursor=0, backward=False, pattern=None):
+    """Возвращает страницу записей после (или до) id-курсора и признак наличия следующей."""
+    table, column, _ = CONTACT_TABLES[kind]
+    expr = CONTACT_FILTER_EXPR[kind]
+    if backward:
+        query = (f"SELECT id, {column} FROM {table} WHERE id < $1 AND ($2::text IS NULL OR {expr} LIKE $2) "
+                 f"ORDER BY id DESC LIMIT $3")
     else:
-        await update.message.reply_text(services_info_formatted)
+        query = (f"SELECT id, {column} FROM {table} WHERE id > $1 AND ($2::text IS NULL OR {expr} LIKE $2) "
+                 f"ORDER BY id LIMIT $3")
+    rows = await db_query(query, args=(cursor, pattern, PAGE_SIZE + 1))
+    if rows is False:
+        return False
+    has_more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+def render_contacts_page(kind, rows, has_prev, has_next):
+    _, column, title = CONTACT_TABLES[kind]
+    if not rows:
+        return "Записей не найдено.", None
+    text = f"{title}:\n" + "\n".join(f"{row['id']}. {row[column]}" for row in rows)
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("◀ Назад", callback_data=f"page:{kind}:prev:{rows[0]['id']}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперед ▶", callback_data=f"page:{kind}:next:{rows[-1]['id']}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def send_contacts_page(update: Update, context: CallbackContext, kind) -> None:
+    pattern = contact_filter_pattern(kind, " ".join(context.args or []))
+    context.user_data[f"page_filter_{kind}"] = pattern
+    page = await fetch_contacts_page(kind, pattern=pattern)
+    if page is False:
+        reply_later(update, context, "Ошибка при получении данных из БД")
+        return
+    rows, has_next = page
+    text, reply_markup = render_contacts_page(kind, rows, False, has_next)
+    reply_later(update, context, text, reply_markup=reply_markup)
+
+
+async def contacts_page_handler(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await query.answer()
+    _, kind, direction, cursor = query.data.split(":")
+    backward = direction == "prev"
+    page = await fetch_contacts_page(kind, int(cursor), backward, context.user_data.get(f"page_filter_{kind}"))
+    if page is False:
+        await query.edit_message_text("Ошибка при получении данных из БД")
+        return
+    rows, has_more = page
+    has_prev, has_next = (has_more, True) if backward else (True, has_more)
+    text, reply_markup = render_contacts_page(kind, rows, has_prev, has_next)
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-    return ConversationHandler.END
 
-async def get_repl_logs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    command = "cat /var/log/postgresql/* | grep repl | tail -n 10"
-    repl_logs_info = ssh(command)
-    if repl_logs_info:
-        log_lines = repl_logs_info.split('\n')
+async def get_emails(update: Update, context: CallbackContext) -> None:
+    await send_contacts_page(update, context, "emails")
 
-        for line in log_lines:
+async def get_phone_numbers(update: Update, context: CallbackContext) -> None:
+    await send_contacts_page(update, context, "phones")
+
+
+# Нормализация в SQL повторяет normalize_email и format_phone_number, чтобы
+# импорт не переносил строки в Python.
+IMPORT_NORMALIZE = {
+    "emails": (
+        "substring(value FROM '^(.*)@') || '@' || lower(substring(value FROM '@([^@]*)$'))",
+        r"value ~ '^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$'",
+    ),
+    "phones": (
+        "CASE WHEN left(digits, 1) = '8' THEN '8' ELSE '+7' END || ' (' || substr(digits, 2, 3) || ') ' "
+        "|| substr(digits, 5, 3) || '-' || substr(digits, 8, 2) || '-' || substr(digits, 10, 2)",
+        "digits ~ '^[78][0-9]{10}$'",
+    ),
+}
+IMPORT_FILE = 0
+
+
+async def export_contacts(update: Update, context: CallbackContext, kind) -> None:
+    """Выгружает таблицу в CSV через COPY TO STDOUT во временный файл и отправляет его."""
+    table, column, title = CONTACT_TABLES[kind]
+    document = tempfile.TemporaryFile()
+    try:
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            with metrics.timer("db", "COPY"):
+                status = await conn.copy_from_query(f"SELECT {column} FROM {table} ORDER BY id",
+                                                    output=document, format="csv", header=True)
+    except Exception as error:
+        document.close()
+        logging.error("Ошибка при выгрузке %s: %s", table, error)
+        reply_later(update, context, "Ошибка при выгрузке данных из базы данных.")
+        return
+    rows = int(status.split()[-1])
+    send_scheduler.enqueue(context.bot, update.effective_chat.id, text=f"{title}: {rows}",
+                           document=document, filename=f"{kind}.csv")
+
+
+async def export_emails(update: Update, context: CallbackContext) -> None:
+    await export_contacts(update, context, "emails")
+
+async def export_phones(update: Update, context: CallbackContext) -> None:
+    await export_contacts(update, context, "phones")
+
+
+async def import_contacts(kind, path):
+    """Загружает CSV через COPY FROM во временную таблицу и добавляет новые значения.
+
+    Возвращает пару (строк в файле, добавлено).
+    """
+    table, column, _ = CONTACT_TABLES[kind]
+    normalized, valid = IMPORT_NORMALIZE[kind]
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            with metrics.timer("db", "COPY"):
+                await conn.execute("CREATE TEMP TABLE contact_import (value text) ON COMMIT DROP")
+                status = await conn.copy_to_table("contact_import", source=path, format="csv")
+                # Заголовок, который пишет /export_*, — не данные и не пропущенная строка.
+                header = await conn.execute("DELETE FROM contact_import WHERE trim(value) = $1", column)
+                result = await conn.execute(
+                    f"INSERT INTO {table} ({column}) "
+                    f"SELECT DISTINCT {normalized} FROM ("
+                    f"SELECT trim(value) AS value, regexp_replace(value, '\\D', '', 'g') AS digits "
+                    f"FROM contact_import) AS rows WHERE {valid} "
+                    # Как и в bulk_insert: уникального индекса может не быть, если
+                    # ensure_indexes не смог его создать на таблице с дубликатами.
+                    f"AND NOT EXISTS (SELECT 1 FROM {table} WHERE {column} = {normalized}) "
+                    f"ON CONFLICT DO NOTHING"
+                )
+    # Новые значения попадут в индекс через обычную инкрементальную подгрузку.
+    await refresh_contact_indexes()
+    return int(status.split()[-1]) - int(header.split()[-1]), int(result.split()[-1])
+
+
+async def import_command(update: Update, context: CallbackContext, kind) -> int:
+    context.user_data["import_kind"] = kind
+    reply_later(update, context, "Отправьте CSV-файл с одним столбцом значений. Для отмены — /cancel.")
+    return IMPORT_FILE
+
+
+async def import_emails_command(update: Update, context: CallbackContext) -> int:
+    return await import_command(update, context, "emails")
+
+async def import_phones_command(update: Update, context: CallbackContext) -> int:
+    return await import_command(update, context, "phones")
+
+
+async def import_file(update: Update, context: CallbackContext) -> int:
+    kind = context.user_data.pop("import_kind", None)
+    if kind not in CONTACT_TABLES:
+        # Тип импорта теряется, если диалог пережил перезапуск без user_data.
+        reply_later(update, context, "Не удалось определить тип импорта. Повторите /import_emails или /import_phones.")
+        return ConversationHandler.END
+    file = await update.message.document.get_file()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = await file.download_to_drive(Path(tmp) / "import.csv")
+        try:
+            rows, inserted = await import_contacts(kind, str(path))
+        except Exception as error:
+            logging.error("Ошибка при импорте %s: %s", kind, error)
+            reply_later(update, context, f"Ошибка импорта: {error}")
+            return ConversationHandler.END
+    reply_later(update, context, f"Строк в файле: {rows}. Добавлено: {inserted}, "
+                                 f"пропущено (дубликаты и некорректные): {rows - inserted}")
+    return ConversationHandler.END
 
-            if "repl" in line:
 
-                await update.message.reply_text(line)
-    else:
-        await update.message.reply_text("Нет данных о репликации в логах.")
-    return ConversationHandler.END
-    
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+metrics_server = None
 
-async def get_emails(update: Update, context: CallbackContext) -> None:
-    query = "SELECT email FROM email_addresses;"
-    emails = await db_query(query)
-    clean_email = [email[0] for email in emails]
-    formatted_emails = "\n".join([f"{i+1}. {email}" for i, email in enumerate(clean_email)])   
 
-    await update.message.reply_text(formatted_emails)
+async def stats(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        reply_later(update, context, "Команда доступна только администраторам.")
+        return
+    pool = db_pool_stats()
+    text = (metrics.summary() or "Нет данных.") + (
+        f"\n\nБД: запросов {pool['queries']}, ошибок {pool['errors']}, "
+        f"ожидание соединения {pool['avg_acquire_wait'] * 1000:.1f} мс, запрос {pool['avg_query_time'] * 1000:.1f} мс"
+    )
+    reply_later(update, context, text)
+
+
+def instrumented(callback):
+    """Оборачивает обработчик замером времени с меткой по имени функции."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with metrics.timer("handler", callback.__name__):
+            return await callback(update, context)
+    return wrapper
+
+
+def instrument_handlers(application) -> None:
+    """Подключает замеры ко всем обработчикам приложения, включая вложенные в диалоги."""
+    def walk(handlers):
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                walk(handler.entry_points)
+                walk(handler.fallbacks)
+                for state_handlers in handler.states.values():
+                    walk(state_handlers)
+            else:
+                handler.callback = instrumented(handler.callback)
+
+    for group in application.handlers.values():
+        walk(group)
 
-async def get_phone_numbers(update: Update, context: CallbackContext) -> None:
-    query = "SELECT phone_number FROM phone_numbers;"
-    phones = await db_query(query)
-    clean_phone = [phone[0] for phone in phones]
-    formatted_phone = "\n".join([f"{i+1}. {phone}" for i, phone in enumerate(clean_phone)])   
 
-    await update.message.reply_text(formatted_phone)
+async def on_startup(application) -> None:
+    global contact_index_task, host_metrics_task, repl_log_task, metrics_server
+    if METRICS_PORT:
+        metrics_server = await serve_prometheus(metrics, METRICS_HOST, METRICS_PORT)
+    try:
+        await get_db_pool()
+        await ensure_indexes()
+        await ensure_host_metrics_table()
+    except Exception as error:
+        # Пул будет создан повторно при первом запросе к БД.
+        print(f"Ошибка при подключении к PostgreSQL: {error}")
+    await refresh_contact_indexes(full=True)
+    contact_index_task = asyncio.create_task(contact_index_refresher())
+    if HOST_METRICS_INTERVAL > 0:
+        host_metrics_task = asyncio.create_task(host_metrics_collector())
+    repl_log_task = asyncio.create_task(repl_log.follow(application.bot))
+    if application.persistence is not None:
+        application.persistence.attach(application)
+
+
+async def on_stop(application) -> None:
+    # post_shutdown вызывается уже после закрытия HTTP-клиента бота, поэтому
+    # задачи сообщают об отмене, а очередь отправки дописывается здесь, пока
+    # бот еще может отправлять.
+    if job_manager is not None:
+        await job_manager.close()
+    await send_scheduler.close()
+
+
+async def on_shutdown(application) -> None:
+    global db_pool, scan_pool, contact_index_task, host_metrics_task, repl_log_task, metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        metrics_server = None
+    if contact_index_task is not None:
+        contact_index_task.cancel()
+        contact_index_task = None
+    if host_metrics_task is not None:
+        host_metrics_task.cancel()
+        host_metrics_task = None
+    if repl_log_task is not None:
+        repl_log_task.cancel()
+        repl_log_task = None
+    for pool in ssh_pools.values():
+        pool.close()
+    ssh_pools.clear()
+    if scan_pool is not None:
+        scan_pool.shutdown(wait=False, cancel_futures=True)
+        scan_pool = None
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных чатов параллельно, а одного чата — по порядку.
+
+    Пока обновление чата обрабатывается, следующие обновления этого чата ставятся
+    в его очередь и сразу освобождают слот, так что один занятый чат не
+    удерживает больше одного из max_concurrent_updates слотов.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._pending = {}
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._key(update)
+        if key is None:
+            await coroutine
+            return
+        queue = self._pending.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        queue = self._pending[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue.popleft()
+                except Exception:
+                    logging.exception("Ошибка при обработке обновления чата %s", key)
+        finally:
+            del self._pending[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 def main() -> None:
 
     """Run the bot."""
+    log_listener = setup_logging()
+    # Состояние диалогов и user_data хранится в PostgreSQL, чтобы несколько
+    # экземпляров бота могли обслуживать одних пользователей и переживать перезапуск.
+    persistence = None
+    if os.getenv("PERSISTENCE", "postgres") != "off":
+        persistence = PostgresPersistence(get_db_pool, float(os.getenv("PERSISTENCE_FLUSH", "5")),
+                                          os.getenv("INSTANCE_ID"))
     # Create the Application and pass it your bot's token.
-    application = ApplicationBuilder().token(os.getenv("TOKEN")).build()
+    builder = (
+        ApplicationBuilder()
+        .token(os.getenv("TOKEN"))
+        .request(TimedRequest(connection_pool_size=256))
+        .concurrent_updates(PerChatUpdateProcessor(int(os.getenv("UPDATE_WORKERS", "8"))))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
 
     convHandlerFindPhoneNumbers = ConversationHandler(
     entry_points=[CommandHandler("find_phone_number", find_phone_numbersCommand)],
     states={
-        FIND_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, find_phone_number)],
+        FIND_PHONE: [MessageHandler((filters.TEXT & ~filters.COMMAND) | UPLOAD_FILTER, find_phone_number)],
         CONFIRM_PHONE: [CallbackQueryHandler(button_handler, pattern='^(save_phone|cancel)$')],
     },
-    fallbacks=[CommandHandler('cancel', cancel)]
+    fallbacks=[CommandHandler('cancel', cancel)],
+    name="find_phone_number",
+    persistent=persistence is not None,
 )
 
     convHandlerfind_email = ConversationHandler(
        entry_points=[CommandHandler("find_email", find_emailCommand)],
     states={
-        FIND_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, find_email)],
+        FIND_EMAIL: [MessageHandler((filters.TEXT & ~filters.COMMAND) | UPLOAD_FILTER, find_email)],
         CONFIRM_EMAIL: [CallbackQueryHandler(button_handler, pattern='^(save_emails|cancel)$')],
     },
-    fallbacks=[CommandHandler('cancel', cancel)]
+    fallbacks=[CommandHandler('cancel', cancel)],
+    name="find_email",
+    persistent=persistence is not None,
 )
 
     conv_handlerget_apt_list = ConversationHandler(
@@ -532,15 +2247,31 @@ def main() -> None:
         states={
             ASK_PACKAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_apt_list)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="get_apt_list",
+        persistent=persistence is not None,
     )
     
+    conv_handlerimport_contacts = ConversationHandler(
+        entry_points=[CommandHandler("import_emails", import_emails_command),
+                      CommandHandler("import_phones", import_phones_command)],
+        states={
+            IMPORT_FILE: [MessageHandler(filters.Document.FileExtension("csv") | filters.Document.FileExtension("txt"),
+                                         import_file)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="import_contacts",
+        persistent=persistence is not None,
+    )
+
     conv_handlerverify_password = ConversationHandler(
         entry_points=[CommandHandler("verify_password", verify_password)],
         states={
             ASK_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, check_password)],
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="verify_password",
+        persistent=persistence is not None,
     )
 
     application.add_handler(CommandHandler("start", start))
@@ -549,6 +2280,7 @@ def main() -> None:
     application.add_handler(convHandlerfind_email)
     application.add_handler(conv_handlerverify_password)
     application.add_handler(conv_handlerget_apt_list)
+    application.add_handler(conv_handlerimport_contacts)
     application.add_handler(CommandHandler("get_release", get_release))
     application.add_handler(CommandHandler("get_uname", get_uname))
     application.add_handler(CommandHandler("get_uptime", get_uptime))
@@ -556,18 +2288,44 @@ def main() -> None:
     application.add_handler(CommandHandler("get_free", get_free))
     application.add_handler(CommandHandler("get_mpstat", get_mpstat))
     application.add_handler(CommandHandler("get_w", get_w))
+    application.add_handler(CommandHandler("get_trend", get_trend))
+    application.add_handler(CommandHandler("hosts", list_hosts))
+    application.add_handler(CommandHandler("jobs", list_jobs))
+    application.add_handler(CommandHandler("job", job_result))
+    application.add_handler(CommandHandler("cancel_job", cancel_job))
     application.add_handler(CommandHandler("get_auths", get_auths))
     application.add_handler(CommandHandler("get_critical", get_critical))
     application.add_handler(CommandHandler("get_ps", get_ps))
     application.add_handler(CommandHandler("get_ss", get_ss))
     application.add_handler(CommandHandler("get_services", get_services))
+    application.add_handler(CallbackQueryHandler(apt_page_handler, pattern=r'^apt:\d+$'))
     application.add_handler(CommandHandler("get_repl_logs", get_repl_logs))
     application.add_handler(CommandHandler("get_emails", get_emails))
     application.add_handler(CommandHandler("get_phone_numbers", get_phone_numbers))
+    application.add_handler(CommandHandler("export_emails", export_emails))
+    application.add_handler(CommandHandler("export_phones", export_phones))
+    application.add_handler(CallbackQueryHandler(contacts_page_handler, pattern=r'^page:(emails|phones):(prev|next):\d+$'))
+    application.add_handler(CommandHandler("stats", stats))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
+    instrument_handlers(application)
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        if os.getenv("BOT_MODE", "polling") == "webhook":
+            # Требует python-telegram-bot[webhooks] (tornado).
+            application.run_webhook(
+                listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+                port=int(os.getenv("WEBHOOK_PORT", "8443")),
+                url_path=os.getenv("WEBHOOK_PATH", ""),
+                webhook_url=os.getenv("WEBHOOK_URL"),
+                secret_token=os.getenv("WEBHOOK_SECRET"),
+                max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
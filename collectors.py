@@ -0,0 +1,404 @@
+"""Сборщики состояния удаленного хоста в машиночитаемом формате.
+
+Каждый сборщик строит команду с фильтрацией и ограничением числа строк на
+стороне сервера, разбирает ее вывод в типизированные записи и форматирует их.
+"""
+import json
+import re
+import shlex
+from datetime import datetime
+from typing import NamedTuple
+
+NAME_REGEX = re.compile(r'^[A-Za-z0-9_.@*:-]+$')
+SS_STATES = {
+    "established", "syn-sent", "syn-recv", "fin-wait-1", "fin-wait-2", "time-wait",
+    "closed", "close-wait", "last-ack", "listening", "closing", "connected", "synchronized",
+}
+SERVICE_STATES = {"running", "exited", "failed", "active", "inactive", "dead", "waiting"}
+
+
+class SocketRecord(NamedTuple):
+    netid: str
+    state: str
+    recv_q: int
+    send_q: int
+    local: str
+    peer: str
+
+
+class ServiceRecord(NamedTuple):
+    unit: str
+    load: str
+    active: str
+    sub: str
+    description: str
+
+
+class AuthRecord(NamedTuple):
+    user: str
+    tty: str
+    host: str
+    started: str
+    ended: str
+
+
+class ProcessRecord(NamedTuple):
+    pid: int
+    user: str
+    cpu: float
+    mem: float
+    command: str
+
+
+class JournalRecord(NamedTuple):
+    timestamp: datetime
+    identifier: str
+    message: str
+
+
+def _split_args(args):
+    """Отделяет число (top-N) от остальных аргументов; refresh, bg и diff обрабатываются ботом."""
+    limit = None
+    words = []
+    for arg in args or []:
+        if arg.isdigit():
+            limit = int(arg)
+        elif arg.lower() not in ("refresh", "bg", "diff"):
+            words.append(arg)
+    return limit, words
+
+
+def _safe_name(value):
+    if not NAME_REGEX.match(value):
+        raise ValueError(f"Недопустимый аргумент: {value}")
+    return shlex.quote(value)
+
+
+# --- ss ----------------------------------------------------------------------
+
+def ss_command(args):
+    """Аргументы: tcp, udp, listen, имя состояния (established, time-wait, ...), N."""
+    limit, words = _split_args(args)
+    protocols = []
+    state = None
+    listening = False
+    for word in (w.lower() for w in words):
+        if word in ("tcp", "udp"):
+            protocols.append(word)
+        elif word in ("listen", "listening"):
+            listening = True
+        elif word in SS_STATES:
+            state = word
+        else:
+            raise ValueError(f"Неизвестный фильтр: {word}")
+    flags = " ".join(f"-{p[0]}" for p in protocols or ("tcp", "udp"))
+    command = f"ss -H -n {flags}"
+    if listening:
+        command += " -l"
+    if state:
+        command += f" state {state}"
+    if limit:
+        command += f" | head -n {limit}"
+    netid = protocols[0] if len(protocols) == 1 else None
+    return command, {"netid": netid, "state": state}
+
+
+def parse_ss(output, netid=None, state=None):
+    """Разбирает вывод ss -H -n.
+
+    Столбцы Netid и State ss опускает, если выбран один протокол или одно
+    состояние, поэтому строка разбирается справа, а недостающее берется из фильтра.
+    """
+    records = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) < 4:
+            continue
+        prefix = parts[:-4]
+        recv_q, send_q, local, peer = parts[-4:]
+        record_netid = prefix.pop(0) if netid is None and prefix else netid
+        record_state = prefix.pop(0) if state is None and prefix else state
+        records.append(SocketRecord(record_netid, record_state, int(recv_q), int(send_q), local, peer))
+    return records
+
+
+def format_socket(record):
+    return (f"Тип сокета: {record.netid}\nСостояние: {record.state}\n"
+            f"Локальный адрес: {record.local}\nУдаленный адрес: {record.peer}\n--")
+
+
+# --- systemctl ---------------------------------------------------------------
+
+def services_command(args):
+    """Аргументы: состояние (running, failed, ...), шаблон имени юнита, N."""
+    limit, words = _split_args(args)
+    state = "running"
+    patterns = []
+    for word in words:
+        if word.lower() in SERVICE_STATES:
+            state = word.lower()
+        else:
+            patterns.append(_safe_name(word))
+    base = f"systemctl list-units --type=service --state={state} --no-pager"
+    if patterns:
+        base += " " + " ".join(patterns)
+    # list-units выводит JSON начиная с systemd 246; более старые версии молча
+    # принимают -o как режим журнала и печатают таблицу, поэтому версия
+    # проверяется явно. JSON приходит одной строкой: top-N применяется при разборе.
+    command = (f"if [ \"$(systemctl --version | awk 'NR==1{{print $2+0}}')\" -ge 246 ]; "
+               f"then {base} --output=json; else {base} --plain --no-legend; fi")
+    return command, {"limit": limit}
+
+
+def parse_services(output, limit=None):
+    output = output.strip()
+    records = []
+    if output.startswith("["):
+        for unit in json.loads(output):
+            records.append(ServiceRecord(unit["unit"], unit["load"], unit["active"], unit["sub"],
+                                         unit.get("description", "")))
+    else:
+        for line in output.splitlines():
+            parts = line.lstrip("●* ").split(None, 4)
+            # Заголовок и легенда таблицы не похожи на имя юнита (unit.service).
+            if len(parts) < 4 or "." not in parts[0]:
+                continue
+            records.append(ServiceRecord(*parts[:4], parts[4] if len(parts) > 4 else ""))
+    return records[:limit] if limit else records
+
+
+def format_service(record):
+    return (f"Сервис: {record.unit}\nЗагрузка: {record.load}\nСостояние: {record.active}\n"
+            f"Статус: {record.sub}\nИнформация: {record.description}\n--")
+
+
+# --- last --------------------------------------------------------------------
+
+def auths_command(args):
+    """Аргументы: имя пользователя, N (по умолчанию 10)."""
+    limit, words = _split_args(args)
+    users = " ".join(_safe_name(word) for word in words)
+    command = f"last -i -n {limit or 10} --time-format iso {users}".rstrip()
+    return command, {}
+
+
+def parse_auths(output):
+    """Разбирает вывод last --time-format iso: время — один столбец, без смещений."""
+    records = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) < 4 or parts[0] == "wtmp":
+            continue
+        user = parts[0]
+        if user in ("reboot", "shutdown"):
+            # reboot system boot <адрес> <начало> ...: с -i вместо версии ядра стоит 0.0.0.0.
+            records.append(AuthRecord(user, parts[1], parts[3], parts[4] if len(parts) > 4 else "",
+                                      " ".join(parts[5:])))
+        else:
+            records.append(AuthRecord(user, parts[1], parts[2], parts[3], " ".join(parts[4:]).lstrip("- ")))
+    return records
+
+
+def format_auth(record):
+    if record.user in ("reboot", "shutdown"):
+        return f"Перезагрузка/выключение системы: {record.started}\n--"
+    return f"Пользователь: {record.user}\nIP/Хост: {record.host}\nВремя: {record.started}\n--"
+
+
+# --- ps ----------------------------------------------------------------------
+
+def ps_command(args):
+    """Аргументы: cpu или mem (сортировка), имя пользователя, N (по умолчанию 10)."""
+    limit, words = _split_args(args)
+    sort = "-pcpu"
+    users = []
+    for word in words:
+        if word.lower() in ("cpu", "mem"):
+            sort = f"-p{word.lower()}"
+        else:
+            users.append(_safe_name(word))
+    selector = f"-u {','.join(users)}" if users else "-e"
+    command = f"ps {selector} -o pid=,user=,pcpu=,pmem=,comm= --sort={sort} | head -n {limit or 10}"
+    return command, {}
+
+
+def parse_ps(output):
+    records = []
+    for line in output.splitlines():
+        parts = line.split(None, 4)
+        if len(parts) < 5:
+            continue
+        records.append(ProcessRecord(int(parts[0]), parts[1], float(parts[2]), float(parts[3]), parts[4]))
+    return records
+
+
+def format_process(record):
+    return f"{record.pid} {record.user} CPU {record.cpu:.1f}% MEM {record.mem:.1f}% {record.command}"
+
+
+# --- journalctl --------------------------------------------------------------
+
+def critical_command(args):
+    """Аргументы: N (по умолчанию 5)."""
+    limit, _ = _split_args(args)
+    command = (f"journalctl -r -p crit -n {limit or 5} -o json "
+               f"--output-fields=MESSAGE,SYSLOG_IDENTIFIER --no-pager")
+    return command, {}
+
+
+def _journal_text(value):
+    # Сообщения с непечатаемыми символами journalctl отдает массивом байтов.
+    if isinstance(value, list):
+        return bytes(value).decode(errors="replace")
+    return value or ""
+
+
+def parse_journal(output):
+    records = []
+    for line in output.splitlines():
+        if not line.startswith("{"):
+            continue
+        entry = json.loads(line)
+        timestamp = datetime.fromtimestamp(int(entry["__REALTIME_TIMESTAMP"]) / 1_000_000)
+        records.append(JournalRecord(timestamp, _journal_text(entry.get("SYSLOG_IDENTIFIER")),
+                                     _journal_text(entry.get("MESSAGE"))))
+    return records
+
+
+def format_journal(record):
+    return f"{record.timestamp:%Y-%m-%d %H:%M:%S} {record.identifier}: {record.message}"
+
+
+# --- снимок хоста ------------------------------------------------------------
+
+class MetricSample(NamedTuple):
+    metric: str
+    label: str
+    value: float
+
+
+class HostSnapshot(NamedTuple):
+    taken_at: datetime
+    sections: dict
+    samples: list
+
+
+SECTION_MARK = "@@"
+# Человекочитаемый вывод для /get_* и машиночитаемый для временных рядов; stderr
+# каждой команды попадает в ее секцию, чтобы отсутствие одной утилиты не ломало снимок.
+SNAPSHOT_SECTIONS = (
+    ("uptime", "uptime"),
+    ("df", "df -h"),
+    ("free", "free -h"),
+    ("mpstat", "mpstat"),
+    ("w", "w"),
+    ("loadavg", "cat /proc/loadavg"),
+    ("df_bytes", "df -P -B1 -x tmpfs -x devtmpfs -x squashfs -x overlay"),
+    ("free_bytes", "free -b"),
+)
+
+
+def host_snapshot_command():
+    return "; ".join(f"echo {SECTION_MARK}{name}; {command} 2>&1" for name, command in SNAPSHOT_SECTIONS)
+
+
+def _number(value):
+    return float(value.replace(",", "."))
+
+
+def parse_host_snapshot(output, taken_at):
+    sections = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith(SECTION_MARK):
+            current = line[len(SECTION_MARK):]
+            sections[current] = []
+        elif current is not None:
+            sections[current].append(line)
+    sections = {name: "\n".join(lines) for name, lines in sections.items()}
+
+    samples = []
+    try:
+        load = sections.get("loadavg", "").split()
+        for metric, value in zip(("load1", "load5", "load15"), load[:3]):
+            samples.append(MetricSample(metric, "", _number(value)))
+    except ValueError:
+        pass
+    for line in sections.get("df_bytes", "").splitlines()[1:]:
+        parts = line.split(None, 5)
+        if len(parts) == 6 and parts[2].isdigit() and parts[3].isdigit():
+            used, available = int(parts[2]), int(parts[3])
+            if used + available:
+                samples.append(MetricSample("disk", parts[5], 100.0 * used / (used + available)))
+    for line in sections.get("free_bytes", "").splitlines():
+        parts = line.split()
+        if parts[:1] == ["Mem:"] and len(parts) >= 7 and int(parts[1]):
+            samples.append(MetricSample("mem", "", 100.0 * (int(parts[1]) - int(parts[6])) / int(parts[1])))
+        elif parts[:1] == ["Swap:"] and len(parts) >= 3 and int(parts[1]):
+            samples.append(MetricSample("swap", "", 100.0 * int(parts[2]) / int(parts[1])))
+    for line in sections.get("mpstat", "").splitlines():
+        parts = line.split()
+        if "all" in parts:
+            try:
+                samples.append(MetricSample("cpu", "", 100.0 - _number(parts[-1])))
+            except ValueError:
+                pass
+            break
+    w_lines = sections.get("w", "").splitlines()
+    if w_lines and " load average" in w_lines[0]:
+        # Первые две строки w — сводка и заголовок таблицы.
+        samples.append(MetricSample("users", "", float(max(len(w_lines) - 2, 0))))
+    return HostSnapshot(taken_at, sections, samples)
+
+
+# --- изменения между снимками ------------------------------------------------
+
+class DeltaSpec(NamedTuple):
+    """Как сравнивать записи сборщика: ключ записи, ее состояние и строка для вывода.
+
+    added и removed — пометки для появившихся и исчезнувших записей.
+    """
+    key: object
+    state: object
+    line: object
+    added: str = ""
+    removed: str = ""
+
+
+SOCKET_DELTA = DeltaSpec(
+    key=lambda r: (r.netid, r.local, r.peer),
+    state=lambda r: r.state or "",
+    line=lambda r: f"{r.netid} {r.state} {r.local} {r.peer}",
+)
+SERVICE_DELTA = DeltaSpec(
+    key=lambda r: r.unit,
+    state=lambda r: f"{r.active}/{r.sub}",
+    line=lambda r: f"{r.unit} {r.active}/{r.sub}",
+)
+# Загрузка сравнивается с точностью до процента, чтобы колебания не считались изменениями.
+# Сравниваются списки top-N, поэтому исчезнувший процесс мог просто выйти из топа.
+PROCESS_DELTA = DeltaSpec(
+    key=lambda r: r.pid,
+    state=lambda r: f"CPU {r.cpu:.0f}% MEM {r.mem:.0f}%",
+    line=format_process,
+    added="(вошел в топ) ",
+    removed="(вышел из топа) ",
+)
+
+
+def format_delta(old, new, spec, since):
+    """Описывает только добавленные, исчезнувшие и изменившиеся записи."""
+    before = {spec.key(record): record for record in old}
+    after = {spec.key(record): record for record in new}
+    added = [record for key, record in after.items() if key not in before]
+    removed = [record for key, record in before.items() if key not in after]
+    changed = [(before[key], record) for key, record in after.items()
+               if key in before and spec.state(before[key]) != spec.state(record)]
+    header = f"Изменения с {since:%H:%M:%S}: +{len(added)} -{len(removed)} ~{len(changed)}, всего {len(after)}"
+    if not (added or removed or changed):
+        return header + ". Без изменений."
+    lines = [header]
+    lines.extend(f"+ {spec.added}{spec.line(record)}" for record in added)
+    lines.extend(f"- {spec.removed}{spec.line(record)}" for record in removed)
+    lines.extend(f"~ {spec.line(record)} (было: {spec.state(previous)})" for previous, record in changed)
+    return "\n".join(lines)
@@ -0,0 +1,105 @@
+"""Счетчики и гистограммы задержек с выводом для /stats и в формате Prometheus."""
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами для Prometheus и окном последних
+    значений для точных перцентилей."""
+
+    def __init__(self, window=1024):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, q):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+
+    def observe(self, kind, label, seconds, error=False):
+        histogram = self.histograms.get((kind, label))
+        if histogram is None:
+            histogram = self.histograms[(kind, label)] = Histogram()
+        histogram.observe(seconds, error)
+
+    @contextmanager
+    def timer(self, kind, label):
+        """Замеряет блок кода; исключение учитывается как ошибка и пробрасывается дальше."""
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(kind, label, time.perf_counter() - started, error)
+
+    def summary(self):
+        """Текстовая сводка: число вызовов, ошибки и p50/p95/p99 в миллисекундах."""
+        lines = []
+        for (kind, label), h in sorted(self.histograms.items()):
+            lines.append(f"{kind}/{label}: n={h.count} err={h.errors} "
+                         f"p50={h.percentile(0.5) * 1000:.0f} p95={h.percentile(0.95) * 1000:.0f} "
+                         f"p99={h.percentile(0.99) * 1000:.0f} мс")
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        lines = [
+            "# HELP bot_latency_seconds Latency of bot operations.",
+            "# TYPE bot_latency_seconds histogram",
+        ]
+        for (kind, label), h in sorted(self.histograms.items()):
+            labels = f'kind="{kind}",name="{label}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, h.buckets):
+                cumulative += count
+                lines.append(f'bot_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'bot_latency_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+            lines.append(f"bot_latency_seconds_sum{{{labels}}} {h.total}")
+            lines.append(f"bot_latency_seconds_count{{{labels}}} {h.count}")
+        lines.append("# HELP bot_errors_total Failed bot operations.")
+        lines.append("# TYPE bot_errors_total counter")
+        for (kind, label), h in sorted(self.histograms.items()):
+            lines.append(f'bot_errors_total{{kind="{kind}",name="{label}"}} {h.errors}')
+        return "\n".join(lines) + "\n"
+
+
+async def serve_prometheus(metrics, host, port):
+    """Минимальный HTTP-сервер, отдающий метрики на любой GET-запрос."""
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = metrics.render_prometheus().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,217 @@
+"""Хранение состояния диалогов и user_data в PostgreSQL для нескольких экземпляров бота."""
+import asyncio
+import json
+import logging
+import os
+import socket
+
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS bot_state (
+    kind text NOT NULL,
+    key text NOT NULL,
+    data text NOT NULL,
+    instance text NOT NULL,
+    txid bigint NOT NULL DEFAULT txid_current(),
+    updated_at timestamptz NOT NULL DEFAULT clock_timestamp(),
+    PRIMARY KEY (kind, key)
+)
+"""
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS bot_state_txid_idx ON bot_state (txid)"
+UPSERT = """
+INSERT INTO bot_state (kind, key, data, instance) VALUES ($1, $2, $3, $4)
+ON CONFLICT (kind, key) DO UPDATE
+SET data = EXCLUDED.data, instance = EXCLUDED.instance, txid = txid_current(), updated_at = clock_timestamp()
+"""
+# Нижняя граница незавершенных транзакций: все транзакции с меньшим номером
+# уже зафиксированы или отменены, и их строки видны любому следующему запросу.
+HORIZON = "SELECT txid_snapshot_xmin(txid_current_snapshot())"
+# Завершенные диалоги и очищенные user_data хранятся как null, чтобы удаление
+# дошло до других экземпляров; такие строки удаляются через час.
+PRUNE = "DELETE FROM bot_state WHERE data = 'null' AND updated_at < clock_timestamp() - interval '1 hour'"
+
+USER_KIND = "user"
+CONVERSATION_PREFIX = "conv:"
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class PostgresPersistence(BasePersistence):
+    """Постоянное хранилище состояний ConversationHandler и user_data в таблице bot_state.
+
+    Запись отложенная: update_* только помечают ключи, а фоновая задача раз в
+    flush_interval секунд сохраняет все изменения одним пакетом. Та же задача
+    забирает строки, записанные другими экземплярами, и применяет их локально:
+    user_data — через refresh_user_data, состояния диалогов — напрямую в
+    словари подключенных ConversationHandler.
+    """
+
+    def __init__(self, get_pool, flush_interval=5.0, instance_id=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.get_pool = get_pool
+        self.flush_interval = flush_interval
+        self.instance_id = instance_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._dirty = {}
+        self._remote_users = {}
+        self._conversations = {}
+        self._horizon = None
+        self._applied = {}
+        self._task = None
+
+    async def _fetch(self, query, *args):
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            if self._horizon is None:
+                await conn.execute(CREATE_TABLE)
+                await conn.execute(CREATE_INDEX)
+                self._horizon = await conn.fetchval(HORIZON)
+            return await conn.fetch(query, *args)
+
+    async def _load(self, kind):
+        try:
+            return await self._fetch("SELECT key, data FROM bot_state WHERE kind = $1 AND data <> 'null'", kind)
+        except Exception as error:
+            # Без БД бот продолжает работать с пустым состоянием, как и без хранилища.
+            logging.error("Не удалось загрузить состояние %s: %s", kind, error)
+            return []
+
+    async def get_user_data(self):
+        return {int(row["key"]): json.loads(row["data"]) for row in await self._load(USER_KIND)}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await self._load(CONVERSATION_PREFIX + name)
+        return {tuple(json.loads(row["key"])): json.loads(row["data"]) for row in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        self._dirty[(CONVERSATION_PREFIX + name, _dumps(list(key)))] = new_state
+
+    async def update_user_data(self, user_id, data):
+        self._dirty[(USER_KIND, str(user_id))] = data
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._dirty[(USER_KIND, str(user_id))] = None
+
+    async def refresh_user_data(self, user_id, user_data):
+        remote = self._remote_users.pop(user_id, None)
+        if remote is not None:
+            user_data.clear()
+            user_data.update(remote)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def attach(self, application):
+        """Запоминает словари состояний постоянных диалогов и запускает фоновую синхронизацию."""
+        def walk(handlers):
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler) and handler.persistent:
+                    # Публичного способа обновить состояние диалога нет; изменения через
+                    # update_no_track и .data не помечаются, поэтому не записываются обратно.
+                    self._conversations[handler.name] = handler._conversations
+        for group in application.handlers.values():
+            walk(group)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._write()
+                await self._pull()
+            except Exception as error:
+                logging.error("Ошибка синхронизации состояния: %s", error)
+
+    async def _write(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        rows = [(kind, key, _dumps(value), self.instance_id) for (kind, key), value in dirty.items()]
+        try:
+            pool = await self.get_pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany(UPSERT, rows)
+                    if any(row[2] == "null" for row in rows):
+                        await conn.execute(PRUNE)
+        except Exception:
+            # Неудачный пакет возвращается в очередь; более свежие значения не затираются.
+            for item, value in dirty.items():
+                self._dirty.setdefault(item, value)
+            raise
+
+    async def _pull(self):
+        """Применяет изменения, записанные другими экземплярами после прошлой синхронизации.
+
+        Курсор — номер транзакции, а не время записи: время берется до фиксации,
+        и строка могла стать видимой позже строки с большим временем. Поэтому
+        перечитываются все транзакции не старше горизонта прошлого опроса, а уже
+        примененные версии строк пропускаются.
+        """
+        if self._horizon is None:
+            await self._fetch("SELECT 1")
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            horizon = await conn.fetchval(HORIZON)
+            rows = await conn.fetch(
+                "SELECT kind, key, data, txid FROM bot_state "
+                "WHERE txid >= $1 AND instance <> $2 ORDER BY txid",
+                self._horizon, self.instance_id,
+            )
+        self._horizon = horizon
+        self._applied = {item: txid for item, txid in self._applied.items() if txid >= horizon}
+        for row in rows:
+            item = (row["kind"], row["key"])
+            if self._applied.get(item) == row["txid"]:
+                continue
+            self._applied[item] = row["txid"]
+            value = json.loads(row["data"])
+            if row["kind"] == USER_KIND:
+                self._remote_users[int(row["key"])] = value or {}
+                continue
+            conversations = self._conversations.get(row["kind"][len(CONVERSATION_PREFIX):])
+            if conversations is None:
+                continue
+            key = tuple(json.loads(row["key"]))
+            if value is None:
+                conversations.data.pop(key, None)
+            else:
+                conversations.update_no_track({key: value})
+
+    async def flush(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self._write()
+        except Exception as error:
+            logging.error("Не удалось сохранить состояние при остановке: %s", error)